@@ -1,4 +1,5 @@
 from flask import Flask
+from .extensions import socketio
 from .routes import main
 
 
@@ -8,5 +9,6 @@ def create_app():
 
     # Register blueprints or extensions
     app.register_blueprint(main)
+    socketio.init_app(app)
 
     return app
@@ -0,0 +1,5 @@
+from flask_socketio import SocketIO
+
+# Extensions are created here without an app and bound in create_app so that
+# blueprints and background jobs can import them without circular imports
+socketio = SocketIO()
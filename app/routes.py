@@ -1,35 +1,41 @@
-import uuid
-from collections import defaultdict
-
-import numpy as np
-from flask import Blueprint, render_template, request, jsonify
+from flask import Blueprint, Response, abort, render_template, request, jsonify, send_file
+from flask_socketio import emit, join_room
 import os
-from app.utils.benjamini_hotchberg import bh_frd_correction
-from app.utils.read_data import (
-    read_umap_coordinates_file,
-    read_meta_data_file,
-    read_pvalues_file,
-    read_bh_reject,
-)
-from app.utils.run_umap_pipeline import run_umap_pipeline
-# from app.utils.tf_analysis import get_pvalues
-from app.utils.run_analysis import get_pvalues
-from app.utils.utils import map_cluster_value, allowed_file
+from app.extensions import socketio
+from app.utils import jobs, metrics, result_format, workspace
+from app.utils.embedding import reembed
+from app.utils.neighbors import BACKEND_LABELS, NEIGHBORS_BACKEND, NEIGHBORS_BACKENDS
+from app.utils.pipeline import run_pipeline
+from app.utils.plot_data import PlotOptions, scatter_traces
+from app.utils.result_format import TF_STATUSES
+from app.utils.result_store import get_session_result
+from app.utils.utils import map_cluster_value, allowed_file, allowed_matrix_file
 
 main = Blueprint("main", __name__)
 
 UPLOAD_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "app/uploads")
-SESSION_ID = str(uuid.uuid4())
 
 
-@main.route("/get_session_id")
-def get_session_id():
-    return jsonify({"session_id": SESSION_ID})
+def session_upload_dir(session_id):
+    # Resolves the workspace of a session, 404 for unknown or malformed IDs
+    if not workspace.workspace_exists(session_id):
+        abort(404)
+    return workspace.workspace_path(session_id)
+
+
+def session_job_id(session_id):
+    # Sessions created by a pipeline job share its ID; the plot page waits for it
+    status_file = os.path.join(workspace.workspace_path(session_id), workspace.JOB_STATUS_FILE)
+    return session_id if os.path.isfile(status_file) else None
 
 
 @main.route("/")
 def index():
-    return render_template("index.html")
+    return render_template(
+        "index.html",
+        neighbors_backends={backend: BACKEND_LABELS[backend] for backend in NEIGHBORS_BACKENDS},
+        neighbors_backend=NEIGHBORS_BACKEND,
+    )
 
 
 @main.route("/plot")
@@ -39,7 +45,8 @@ def view_plot():
 
 @main.route("/plot/<session_id>")
 def view_plot_session_id(session_id):
-    return render_template("plot.html", session_id=session_id)
+    session_upload_dir(session_id)
+    return render_template("plot.html", session_id=session_id, job_id=session_job_id(session_id))
 
 
 # @main.route("/run_analysis", methods=["GET", "POST"])
@@ -118,18 +125,15 @@ def run_umap():
             return "No selected file"
 
         if (data_matrix_file
-                and allowed_file(data_matrix_file.filename)
+                and allowed_matrix_file(data_matrix_file.filename)
                 and meta_data_file
                 and allowed_file(meta_data_file.filename)
                 and prior_data_file
                 and allowed_file(prior_data_file.filename)
         ):
-            print("First Running UMAP Pipeline....")
             # Create an uuid folder to store the uploaded files
-            uuid_folder_name = SESSION_ID
+            uuid_folder_name, upload_dir = workspace.create_workspace(keep=jobs.active_sessions())
             print("uuid_folder_name: ", uuid_folder_name)
-            upload_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "app/uploads/" + uuid_folder_name)
-            os.makedirs(upload_dir)
 
             data_matrix_filename = os.path.join(upload_dir, data_matrix_file.filename)
             meta_data_filename = os.path.join(upload_dir, meta_data_file.filename)
@@ -142,103 +146,142 @@ def run_umap():
             meta_data_file.save(meta_data_filename)
             prior_data_file.save(prior_data_filename)  # for TF analysis
 
-            # Now run the UMAP Pipeline
+            # Optional gene and cell names of a Matrix Market expression matrix
+            matrix_names = {}
+            for field in ("data_genes", "data_cells"):
+                names_file = request.files.get(field)
+                if names_file and names_file.filename != "":
+                    if not allowed_file(names_file.filename):
+                        return trigger_custom_error("Invalid file type")
+                    names_filename = field + "." + names_file.filename.rsplit(".", 1)[1].lower()
+                    names_file.save(os.path.join(upload_dir, names_filename))
+                    matrix_names[field.split("_")[1] + "_filename"] = names_filename
+
+            # Now queue the UMAP Pipeline and the TF analysis
             print("request.form ", request.form)
-            organism = request.form["organism"]
-
-            filter_cells = request.form["filter_cells"]
-            filter_cells_value = request.form["filter_cells_value"]
-            filter_genes = request.form["filter_genes"]
-            filter_genes_value = request.form["filter_genes_value"]
-            qc_filter = request.form["qc_filter"]
-            qc_filter_value = request.form["qc_filter_value"]
-            data_normalize = request.form["data_normalize"]
-            data_normalize_value = request.form["data_normalize_value"]
-            log_transform = request.form["log_transform"]
-
-            pca_components = int(request.form["pca_components"])
-
-            n_neighbors = int(request.form["n_neighbors"])
-            min_dist = float(request.form["min_dist"])
-            metric = request.form["metric"]
-
-            # Now run the UMAP Pipeline
-            umap_df = run_umap_pipeline(
-                data_matrix_filename=data_matrix_filename.split("/")[-1],
-                meta_data_filename=meta_data_filename.split("/")[-1],
-                organism=organism,
-                filter_cells=filter_cells,
-                filter_cells_value=int(filter_cells_value),
-                filter_genes=filter_genes,
-                filter_genes_value=int(filter_genes_value),
-                qc_filter=qc_filter,
-                qc_filter_value=float(qc_filter_value),
-                data_normalize=data_normalize,
-                data_normalize_value=int(data_normalize_value),
-                log_transform=log_transform,
-                pca_components=pca_components,
-                n_neighbors=n_neighbors,
-                min_dist=min_dist,
-                metric=metric,
-                uuid_folder_name=uuid_folder_name
+            umap_params = dict(
+                organism=request.form["organism"],
+                filter_cells=request.form["filter_cells"],
+                filter_cells_value=int(request.form["filter_cells_value"]),
+                filter_genes=request.form["filter_genes"],
+                filter_genes_value=int(request.form["filter_genes_value"]),
+                qc_filter=request.form["qc_filter"],
+                qc_filter_value=float(request.form["qc_filter_value"]),
+                data_normalize=request.form["data_normalize"],
+                data_normalize_value=int(request.form["data_normalize_value"]),
+                log_transform=request.form["log_transform"],
+                pca_components=int(request.form["pca_components"]),
+                n_neighbors=int(request.form["n_neighbors"]),
+                min_dist=float(request.form["min_dist"]),
+                metric=request.form["metric"],
+                neighbors_backend=request.form.get("neighbors_backend", NEIGHBORS_BACKEND),
             )
-            umap_df.to_csv(os.path.join(upload_dir, "umap_coordinates.csv"))
-
-            # Now run the TF analysis
-            print("Running TF analysis....")
+            if umap_params["neighbors_backend"] not in NEIGHBORS_BACKENDS:
+                # Unknown, or its library (hnswlib) is not installed
+                return trigger_custom_error("Neighbor search backend not available")
             iters = int(request.form["iters"])
-            try:
-                p_values = get_pvalues(
-                    prior_data_filename.split("/")[-1],
-                    data_matrix_filename.split("/")[-1],
-                    iters,
-                    upload_dir
-                )
-                p_file_path = os.path.join(upload_dir, "p_values.tsv")
-                p_values.to_csv(p_file_path, sep="\t")
-
-                # Now run the Benjamini-Hochberg FDR correction
-                reject = bh_frd_correction(p_file_path, alpha=0.05)
-                reject_file_path = os.path.join(upload_dir, "reject.tsv")
-                reject.to_csv(reject_file_path, sep="\t")
-
-            except Exception as e:
-                return trigger_custom_error(str(e))
-
-            print("Done with UMAP and TF analysis. Now rendering plot.html")
-            return render_template("plot.html", session_id=uuid_folder_name)
-
-        return trigger_custom_error("Invalid file type")
 
+            job_id = jobs.submit(
+                run_pipeline,
+                upload_dir,
+                data_matrix_filename.split("/")[-1],
+                meta_data_filename.split("/")[-1],
+                prior_data_filename.split("/")[-1],
+                umap_params,
+                iters,
+                **matrix_names,
+                job_id=uuid_folder_name,
+                session_id=uuid_folder_name,
+                status_file=os.path.join(upload_dir, workspace.JOB_STATUS_FILE),
+            )
 
-@main.route("/get_plot_data", methods=["POST"])
-def get_plot_data():
-    print("/get_plot_data", request.json)
-    session_id = request.json["session_id"]
-    print("session_id: ", session_id)
-
-    upload_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "app/uploads/" + session_id)
-
-    umap_data = read_umap_coordinates_file(upload_dir)
-    bh_reject = read_bh_reject(upload_dir)
-    meta_data = read_meta_data_file(upload_dir)
+            print(f"Queued UMAP and TF analysis as job {job_id}. Now rendering plot.html")
+            return render_template("plot.html", session_id=uuid_folder_name, job_id=job_id)
 
-    # create a list dictionary of clusters with coordinates
-    cluster_coordinates = []
+        return trigger_custom_error("Invalid file type")
 
-    unique_clusters = umap_data["Cluster"].unique().tolist()
 
-    for cluster in unique_clusters:
-        cluster_coordinates.append({
+@main.route("/jobs/<job_id>")
+def job_status(job_id):
+    # Pipeline jobs share the ID of their session workspace
+    status_file = None
+    if workspace.workspace_exists(job_id):
+        status_file = os.path.join(workspace.workspace_path(job_id), workspace.JOB_STATUS_FILE)
+    job = jobs.get_job(job_id, status_file=status_file)
+    if job is None:
+        return jsonify({"error": "Unknown job", "job_id": job_id}), 404
+    return jsonify(job)
+
+
+@main.route("/metrics")
+def prometheus_metrics():
+    # Stage timings, memory and cache counters of this server process
+    job_states = jobs.state_counts()
+    body = metrics.render({
+        "tf_jobs": ("Jobs known to this process by state", {(state,): n for state, n in job_states.items()}, ("state",)),
+    })
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+
+@socketio.on("join_job")
+def join_job(data):
+    # The plot page subscribes to the progress events of its job
+    job_id = data["job_id"]
+    join_room(job_id)
+    job = jobs.get_job(job_id)
+    if job is not None:
+        emit("job_progress", job)
+
+
+def plot_options():
+    # Encoding and visible window of the plot, 400 for unknown encodings
+    try:
+        return PlotOptions.from_request(request.json)
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def pca_columns(result):
+    # Principal components to plot, the first two unless the request names others
+    components = request.json.get("pca_components") or [1, 2]
+    try:
+        columns = [f"X_pca{int(component)}" for component in components]
+    except (TypeError, ValueError):
+        abort(400)
+    if len(columns) != 2 or any(column not in result.coordinates for column in columns):
+        abort(400)
+    return columns
+
+
+def cluster_traces(result, x_column, y_column, categories, options):
+    # One scatter trace per category, in order of first appearance
+    traces = []
+    for cluster in categories.labels:
+        traces.append({
             "cluster": cluster,
-            "x": umap_data[umap_data["Cluster"] == cluster]["X_umap1"].tolist(),
-            "y": umap_data[umap_data["Cluster"] == cluster]["X_umap2"].tolist(),
             "mode": "markers",
             "type": "scatter",
             "name": cluster,
             "size": 6,
             "opacity": 0.5,
         })
+    return scatter_traces(result.coordinates[x_column], result.coordinates[y_column], categories, traces, options)
+
+
+@main.route("/get_plot_data", methods=["POST"])
+def get_plot_data():
+    print("/get_plot_data", request.json)
+    session_id = request.json["session_id"]
+    print("session_id: ", session_id)
+
+    upload_dir = session_upload_dir(session_id)
+    session_result = get_session_result(upload_dir)
+    options = plot_options()
+
+    # create a list dictionary of clusters with coordinates
+    cluster_coordinates, points = cluster_traces(
+        session_result, "X_umap1", "X_umap2", session_result.cluster, options
+    )
 
     # Define layout for the plot
     layout = {
@@ -249,14 +292,16 @@ def get_plot_data():
     }
 
     # Count the True values in each column in bh_reject
-    tfs_with_count = bh_reject.apply(lambda x: x.value_counts().get(True, 0)).to_dict()
+    tfs_with_count = dict(zip(session_result.tfs, session_result.significant_counts.tolist()))
 
     # Define Plotly data and layout
     graph_data = {
         "data": cluster_coordinates,
         "layout": layout,
         "tfs": tfs_with_count,
-        "meta_data_cluster": meta_data.columns.tolist()
+        "meta_data_cluster": session_result.meta_data_columns,
+        "pca_components": sum(column.startswith("X_pca") for column in session_result.coordinates),
+        "points": points,
     }
 
     return jsonify(graph_data)
@@ -275,134 +320,152 @@ def update_plot():
         f"session_id: {session_id}\n"
         f"meta_data_cluster: {meta_data_cluster}")
 
-    upload_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "app/uploads/" + session_id)
+    upload_dir = session_upload_dir(session_id)
+    session_result = get_session_result(upload_dir)
+    options = plot_options()
 
-    umap_data = read_umap_coordinates_file(upload_dir)
-    meta_data = read_meta_data_file(upload_dir)
-    bh_reject = read_bh_reject(upload_dir)
+    x_column, y_column = ("X_umap1", "X_umap2") if plot_type == "umap" else pca_columns(session_result)
 
     # create a list dictionary of clusters with coordinates
     cluster_coordinates = []
+    points = None
 
     # No TF should be selected so use the meta_data_cluster column to plot the clusters
     if tf_name == "Select an option" or tf_name == "":
         print("Cluster type is changed to: ", meta_data_cluster)
+        categories = session_result.cluster
         if meta_data_cluster and meta_data_cluster != "Select an option":
-            umap_data["Cluster"] = meta_data[meta_data_cluster].tolist()
-            umap_data["Cluster"] = umap_data["Cluster"].fillna("NaN")
+            categories = session_result.meta_data[meta_data_cluster]
 
         tf_name = ""
-        unique_clusters = umap_data["Cluster"].unique().tolist()
-        if plot_type == "umap":
-            for cluster in unique_clusters:
-                cluster_coordinates.append({
-                    "cluster": cluster,
-                    "x": umap_data[umap_data["Cluster"] == cluster]["X_umap1"].tolist(),
-                    "y": umap_data[umap_data["Cluster"] == cluster]["X_umap2"].tolist(),
-                    "mode": "markers",
-                    "type": "scatter",
-                    "name": cluster,
-                    "size": 6,
-                    "opacity": 0.5,
-                })
-        elif plot_type == "pca":
-            for cluster in unique_clusters:
-                cluster_coordinates.append({
-                    "cluster": cluster,
-                    "x": umap_data[umap_data["Cluster"] == cluster]["X_pca1"].tolist(),
-                    "y": umap_data[umap_data["Cluster"] == cluster]["X_pca2"].tolist(),
-                    "mode": "markers",
-                    "type": "scatter",
-                    "name": cluster,
-                    "size": 6,
-                    "opacity": 0.5,
-                })
+        if plot_type in ("umap", "pca"):
+            cluster_coordinates, points = cluster_traces(session_result, x_column, y_column, categories, options)
     else:
-        p_values = read_pvalues_file(upload_dir)
-
-        umap_data[tf_name] = bh_reject[tf_name].astype(object)
-        umap_data["pvalues"] = p_values[tf_name]
-
-        mask = umap_data[tf_name] == True
-        umap_data.loc[mask, tf_name] = np.where(umap_data.loc[mask, "pvalues"] < 0, "Inactive", "Active")
-        umap_data[tf_name] = umap_data[tf_name].fillna("NaN")
-        umap_data[tf_name] = umap_data[tf_name].replace(False, "Insignificant")
+        status = session_result.tf_status(tf_name)
+        colors = {"Active": "red", "Inactive": "blue", "Insignificant": "gray", "NaN": "gray"}
 
-        # Count Active, Inactive, False and NaN values in the TF column
-        true_false_count = defaultdict(int, umap_data[tf_name].value_counts().to_dict())
-
-        unique_clusters = {
-            f"Active ({true_false_count['Active']})": "red",
-            f"Inactive ({true_false_count['Inactive']})": "blue",
-            f"Insignificant ({true_false_count['False']})": "gray",
-            f"NaN ({true_false_count['NaN']})": "gray"
-        }
-
-        if plot_type == "umap":
-            for cluster in unique_clusters.keys():
+        if plot_type in ("umap", "pca"):
+            for label, count in zip(status.labels, session_result.tf_status_counts(tf_name)):
+                # Count Active, Inactive, Insignificant and NaN values of the TF
+                cluster = f"{label} ({int(count)})"
                 cluster_coordinates.append({
                     "cluster": cluster,
-                    "x": umap_data[umap_data[tf_name] == cluster.split()[0]]["X_umap1"].tolist(),
-                    "y": umap_data[umap_data[tf_name] == cluster.split()[0]]["X_umap2"].tolist(),
                     "mode": "markers",
                     "type": "scatter",
                     "name": cluster,
                     "marker": {
                         "size": 6,
                         "opacity": 0.5,
-                        "color": unique_clusters[cluster]
+                        "color": colors[label]
                     },
                 })
-        elif plot_type == "pca":
-            for cluster in unique_clusters.keys():
-                cluster_coordinates.append({
-                    "cluster": cluster,
-                    "x": umap_data[umap_data[tf_name] == cluster.split()[0]]["X_pca1"].tolist(),
-                    "y": umap_data[umap_data[tf_name] == cluster.split()[0]]["X_pca2"].tolist(),
-                    "mode": "markers",
-                    "type": "scatter",
-                    "name": cluster,
-                    "marker": {
-                        "size": 6,
-                        "opacity": 0.5,
-                        "color": unique_clusters[cluster]
-                    },
-                })
-    title = (
-        f"UMAP Plot - {tf_name}"
-        if plot_type == "umap"
-        else f"Top 2 PCA Components Plot - {tf_name}"
-    )
+            cluster_coordinates, points = scatter_traces(
+                session_result.coordinates[x_column],
+                session_result.coordinates[y_column],
+                status,
+                cluster_coordinates,
+                options,
+            )
+    if plot_type == "umap":
+        title, x_title, y_title = f"UMAP Plot - {tf_name}", "UMAP1", "UMAP2"
+    elif (x_column, y_column) == ("X_pca1", "X_pca2"):
+        title, x_title, y_title = f"Top 2 PCA Components Plot - {tf_name}", "PCA1", "PCA2"
+    else:
+        x_title, y_title = x_column[2:].upper(), y_column[2:].upper()
+        title = f"{x_title} vs {y_title} Plot - {tf_name}"
 
     # Define layout for the plot
     layout = {
         "title": title,
-        "xaxis": {"title": "UMAP1" if plot_type == "umap" else "PCA1"},
-        "yaxis": {"title": "UMAP2" if plot_type == "umap" else "PCA2"},
+        "xaxis": {"title": x_title},
+        "yaxis": {"title": y_title},
         "hovermode": "closest",
     }
 
     # Count the True values in each column in bh_reject
-    tfs_with_count = bh_reject.apply(lambda x: x.value_counts().get(True, 0)).to_dict()
+    tfs_with_count = dict(zip(session_result.tfs, session_result.significant_counts.tolist()))
 
     # Define Plotly data and layout
     graph_data = {
         "data": cluster_coordinates,
         "layout": layout,
         "tfs": tfs_with_count,
-        "meta_data_cluster": meta_data.columns.tolist()
+        "meta_data_cluster": session_result.meta_data_columns,
+        "pca_components": sum(column.startswith("X_pca") for column in session_result.coordinates),
+        "points": points,
     }
 
     return jsonify(graph_data)
 
 
+@main.route("/reembed", methods=["POST"])
+def reembed_session():
+    # Queues a new UMAP embedding of a finished session from its stored graph
+    session_id = request.json["session_id"]
+    upload_dir = session_upload_dir(session_id)
+    # The pipeline writes the graph before the UMAP coordinates, and the two
+    # must not write the coordinates at the same time
+    job = jobs.get_job(session_id, status_file=os.path.join(upload_dir, workspace.JOB_STATUS_FILE))
+    if job is None or job["state"] != jobs.DONE or session_id in jobs.active_sessions():
+        return jsonify({"error": "The analysis of this session has not finished"}), 409
+    if not result_format.has_result(upload_dir, "pca"):
+        return jsonify({"error": "No neighbors graph stored for this session"}), 409
+    try:
+        min_dist = float(request.json["min_dist"])
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    if not 0 <= min_dist <= 1:
+        abort(400)
+
+    job_id = jobs.submit(reembed, upload_dir, min_dist, session_id=session_id)
+    return jsonify({"job_id": job_id})
+
+
+@main.route("/tf_summary/<session_id>/<tf_name>")
+def tf_summary(session_id, tf_name):
+    # Status counts of one TF, in total and per category of the metadata
+    # columns with few enough categories (see SUMMARY_MAX_CATEGORIES)
+    session_result = get_session_result(session_upload_dir(session_id))
+    if tf_name not in session_result.tfs:
+        abort(404)
+
+    counts = session_result.tf_status_counts(tf_name)
+    return jsonify({
+        "tf": tf_name,
+        "counts": dict(zip(TF_STATUSES, counts.tolist())),
+        "clusters": {
+            column: session_result.tf_cluster_counts(tf_name, column)
+            for column in session_result.summary_columns
+        },
+    })
+
+
+@main.route("/download/<session_id>/<file_name>")
+def download_result(session_id, file_name):
+    # Text export of a result table; sessions from before the binary format
+    # still have the text file itself
+    upload_dir = session_upload_dir(session_id)
+    if file_name not in result_format.EXPORTS:
+        abort(404)
+
+    legacy_path = os.path.join(upload_dir, file_name)
+    if os.path.isfile(legacy_path):
+        return send_file(legacy_path, as_attachment=True)
+    if not result_format.has_result(upload_dir, result_format.EXPORTS[file_name]):
+        abort(404)
+    return send_file(result_format.export_table(upload_dir, file_name), as_attachment=True)
+
+
 @main.route("/result", methods=["GET", "POST"])
 def result():
     if request.method == "POST":
-        session_id = request.form["session_id"]
+        session_id = request.form["session_id"].strip()
         print("session_id: ", session_id)
 
-        return render_template("plot.html", session_id=session_id)
+        if not workspace.workspace_exists(session_id):
+            return trigger_custom_error("Unknown session ID")
+
+        return render_template("plot.html", session_id=session_id, job_id=session_job_id(session_id))
 
     else:
         return trigger_custom_error("Invalid request method")
@@ -1,4 +1,8 @@
 let originalData = null;
+// Endpoint and body of the request behind the current plot, asked again with
+// the visible range when the user zooms into a downsampled plot
+let plotRequest = null;
+let viewport = null;
 
 $(document).ready(function () {
     // Initialize DOM elements
@@ -8,8 +12,13 @@ $(document).ready(function () {
     const hideInsignificant = document.getElementById('hide_insignificant');
     const sortTfs = document.getElementById('sort_tfs');
 
-    // Fetch the initial data from server
-    getPlotData();
+    // Fetch the initial data from server, once the analysis job has finished
+    const jobId = document.getElementById('job_id').value;
+    if (jobId) {
+        waitForJob(jobId);
+    } else {
+        getPlotData();
+    }
 
     hideActive.addEventListener('click', function () {
         modifyPlot(hideActive.checked, hideInactive.checked, hideInsignificant.checked)
@@ -32,23 +41,82 @@ $(document).ready(function () {
 });
 
 
+/**
+ * Follows the progress of the analysis job and loads the plot when it is done.
+ * Progress is pushed over Socket.IO; /jobs/<id> is polled if the socket is unavailable.
+ * @param {string} jobId - The ID of the queued analysis job.
+ * @param {Function} onDone - Called once the job has finished, loads the plot by default.
+ */
+function waitForJob(jobId, onDone = getPlotData) {
+    const jobStatus = document.getElementById('job_status');
+    const jobMessage = document.getElementById('job_message');
+    let finished = false;
+    let polling = false;
+
+    jobStatus.classList.remove('hidden');
+
+    function onProgress(job) {
+        if (finished || job.job_id !== jobId) return;
+        jobMessage.textContent = job.message;
+
+        if (job.state === 'done') {
+            finished = true;
+            jobStatus.classList.add('hidden');
+            onDone();
+        } else if (job.state === 'failed') {
+            finished = true;
+            jobMessage.textContent = 'Analysis failed: ' + job.error;
+        }
+    }
+
+    function startPolling() {
+        if (polling) return;
+        polling = true;
+        poll();
+    }
+
+    function poll() {
+        if (finished) return;
+        fetch('/jobs/' + jobId)
+            .then(response => response.json().then(job => {
+                // Unknown jobs and server errors have no state; stop polling them
+                if (!response.ok || !job.state) {
+                    throw new Error(job.error || 'unexpected response (HTTP ' + response.status + ')');
+                }
+                onProgress(job);
+                if (!finished) setTimeout(poll, 5000);
+            }))
+            .catch(error => {
+                console.error("Error fetching job status:", error);
+                finished = true;
+                jobMessage.textContent = 'Could not get the analysis status: ' + error.message;
+            });
+    }
+
+    if (typeof io !== 'undefined') {
+        const socket = io();
+        socket.on('connect', () => socket.emit('join_job', {job_id: jobId}));
+        socket.on('job_progress', onProgress);
+        socket.on('connect_error', startPolling);
+    } else {
+        startPolling();
+    }
+}
+
+
 /**
  * Fetches plot data from the server and initializes the plot.
  */
 function getPlotData() {
-    fetch('/get_plot_data', {
-        method: 'POST',
-        headers: {'Content-Type': 'application/json'},
-        body: JSON.stringify({session_id: document.getElementById('session_id').value})
-    })
-        .then(response => response.json())
+    requestPlot('/get_plot_data', {session_id: document.getElementById('session_id').value})
         .then(data => {
-            originalData = data; // Store the original data
-            Plotly.newPlot('scatterPlot', data.data, data.layout);
-
             // Populate TF List and metadata dropdowns
             populateDropdown('tf_name', Object.keys(data.tfs));
             populateDropdown('meta_data_cluster', data.meta_data_cluster);
+            document.getElementById('pca_x').max = data.pca_components;
+            document.getElementById('pca_y').max = data.pca_components;
+
+            document.getElementById('scatterPlot').on('plotly_relayout', onZoom);
         })
         .catch(error => console.error("Error fetching plot data:", error));
 }
@@ -60,29 +128,120 @@ function getPlotData() {
 function updatePlotNew() {
     const tfName = document.getElementById('tf_name').value;
     const plotInfo = document.getElementById('plot_info');
-    fetch('/update_plot', {
+    const plotType = document.getElementById('plot_type').value;
+    const body = {
+        session_id: document.getElementById('session_id').value,
+        plot_type: plotType,
+        tf_name: tfName,
+        meta_data_cluster: document.getElementById('meta_data_cluster').value,
+    };
+    if (plotType === 'pca') {
+        body.pca_components = [
+            parseInt(document.getElementById('pca_x').value),
+            parseInt(document.getElementById('pca_y').value)
+        ];
+    }
+    viewport = null;
+    requestPlot('/update_plot', body)
+        .then(() => {
+            if (tfName === 'Select an option' || tfName === '') {
+                plotInfo.classList.add('hidden');
+            } else {
+                plotInfo.classList.remove('hidden');
+            }
+        })
+        .catch(error => console.error("Error updating plot:", error));
+
+}
+
+
+/**
+ * Recomputes the UMAP embedding of the session with a new minimum distance
+ * from its stored neighbors graph, then redraws the plot.
+ */
+function reembedUmap() {
+    fetch('/reembed', {
         method: 'POST',
         headers: {'Content-Type': 'application/json'},
         body: JSON.stringify({
             session_id: document.getElementById('session_id').value,
-            plot_type: document.getElementById('plot_type').value,
-            tf_name: tfName,
-            meta_data_cluster: document.getElementById('meta_data_cluster').value,
+            min_dist: parseFloat(document.getElementById('min_dist').value),
         })
     })
         .then(response => response.json())
         .then(data => {
-            originalData = data; // Update the original data
-            Plotly.react('scatterPlot', data.data, data.layout);
-
-            if (tfName === 'Select an option' || tfName === '') {
-                plotInfo.classList.add('hidden');
-            } else {
-                plotInfo.classList.remove('hidden');
+            if (data.error) {
+                console.error("Error re-running UMAP:", data.error);
+                return;
             }
+            document.getElementById('plot_type').value = 'umap';
+            waitForJob(data.job_id, updatePlotNew);
         })
-        .catch(error => console.error("Error updating plot:", error));
+        .catch(error => console.error("Error re-running UMAP:", error));
+}
+
+
+/**
+ * Requests the plot traces as binary typed arrays, limited to the visible
+ * range when zoomed in, and draws them.
+ * @param {string} url - The plot endpoint.
+ * @param {Object} body - The plot options sent to the endpoint.
+ * @returns {Promise<Object>} The plot data.
+ */
+function requestPlot(url, body) {
+    plotRequest = {url: url, body: body};
+    const payload = Object.assign({encoding: 'binary'}, body);
+    if (viewport) {
+        payload.x_range = viewport.x;
+        payload.y_range = viewport.y;
+    }
+
+    return fetch(url, {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify(payload)
+    })
+        .then(response => response.json())
+        .then(data => {
+            if (viewport) {
+                // Keep the zoomed window instead of the autorange of the new traces
+                data.layout.xaxis.range = viewport.x;
+                data.layout.yaxis.range = viewport.y;
+            }
+            originalData = data; // Store the original data
+            modifyPlot(
+                document.getElementById('hide_active').checked,
+                document.getElementById('hide_inactive').checked,
+                document.getElementById('hide_insignificant').checked
+            );
+            return data;
+        });
+}
+
+
+/**
+ * Loads the points of the visible range when zooming into a downsampled plot,
+ * and the downsampled overview again when the zoom is reset.
+ * @param {Object} event - The plotly_relayout event data.
+ */
+function onZoom(event) {
+    if (!plotRequest || !originalData) return;
+
+    if (event['xaxis.autorange'] || event['yaxis.autorange']) {
+        if (!viewport) return;
+        viewport = null;
+    } else if ('xaxis.range[0]' in event || 'yaxis.range[0]' in event) {
+        const layout = document.getElementById('scatterPlot').layout;
+        const zoomed = {x: layout.xaxis.range.slice(), y: layout.yaxis.range.slice()};
+        // Points outside a previous window were never sent
+        if (!originalData.points.downsampled && !viewport) return;
+        viewport = zoomed;
+    } else {
+        return;
+    }
 
+    requestPlot(plotRequest.url, plotRequest.body)
+        .catch(error => console.error("Error loading the zoomed plot:", error));
 }
 
 
@@ -99,17 +258,17 @@ function modifyPlot(hideActive, hideInactive, hideInsignificant) {
 
     if (hideActive)
         filteredData = filteredData.filter(trace => {
-            return trace.marker.color !== 'red';
+            return (trace.marker || {}).color !== 'red';
         });
 
     if (hideInactive)
         filteredData = filteredData.filter(trace => {
-            return trace.marker.color !== 'blue';
+            return (trace.marker || {}).color !== 'blue';
         });
 
     if (hideInsignificant)
         filteredData = filteredData.filter(trace => {
-            return trace.marker.color !== 'gray';
+            return (trace.marker || {}).color !== 'gray';
         });
 
     Plotly.react('scatterPlot', filteredData, originalData.layout);
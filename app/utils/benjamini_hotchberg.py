@@ -1,24 +1,84 @@
+import os
+
+import numpy as np
 import pandas as pd
-from statsmodels.stats.multitest import multipletests
 
+from app.utils.result_format import REJECT_FALSE, REJECT_NAN, REJECT_TRUE
+
+# TFs corrected at once by bh_correct_columns
+BH_BLOCK_COLUMNS = int(os.getenv("BH_BLOCK_COLUMNS", "64"))
+
+
+def benjamini_hochberg(p_values: np.ndarray, alpha=0.05):
+    # Column-wise Benjamini-Hochberg over a cells x TFs matrix with one sort and
+    # one reversed cumulative pass; NaNs are left out of their column. Matches
+    # statsmodels multipletests(abs(column.dropna()), method="fdr_bh") per column.
+    # Returns the boolean reject matrix and the adjusted q-values (NaN where the
+    # p-value is NaN)
+    p_values = np.abs(np.asarray(p_values, dtype=np.float64))
+    if p_values.ndim == 1:
+        reject, q_values = benjamini_hochberg(p_values[:, np.newaxis], alpha)
+        return reject[:, 0], q_values[:, 0]
+
+    n_tests = np.sum(~np.isnan(p_values), axis=0)
+    order = np.argsort(p_values, axis=0)  # NaNs are sorted last
+    p_sorted = np.take_along_axis(p_values, order, axis=0)
+
+    ranks = np.arange(1, len(p_values) + 1)[:, np.newaxis]
+    valid = ranks <= n_tests
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ecdf_factor = ranks / n_tests
+
+        # Every hypothesis up to the largest rejected one is rejected
+        reject_sorted = (p_sorted <= ecdf_factor * alpha) & valid
+        reject_sorted = np.logical_or.accumulate(reject_sorted[::-1], axis=0)[::-1]
+
+        q_sorted = np.where(valid, p_sorted / ecdf_factor, np.inf)
+    q_sorted = np.minimum.accumulate(q_sorted[::-1], axis=0)[::-1]
+    q_sorted[q_sorted > 1] = 1
+    q_sorted[~valid] = np.nan
+
+    reject = np.empty_like(reject_sorted)
+    q_values = np.empty_like(q_sorted)
+    np.put_along_axis(reject, order, reject_sorted, axis=0)
+    np.put_along_axis(q_values, order, q_sorted, axis=0)
+    return reject, q_values
+
+
+def bh_frd_correction(p_values, alpha=0.05):
+    # p_values is the cells x TFs p-value frame or the path of its TSV file.
+    # Returns the reject frame as REJECT_TRUE / REJECT_FALSE / REJECT_NAN codes
+    # and the frame of adjusted q-values
+    if isinstance(p_values, pd.DataFrame):
+        p_value_df = p_values
+    else:
+        p_value_df = pd.read_csv(p_values, sep="\t", index_col=0)
 
-def bh_frd_correction(p_value_file: str, alpha=0.05) -> pd.DataFrame:
-    p_value_df = pd.read_csv(p_value_file, sep="\t", index_col=0)
+    p_value_df = p_value_df.dropna(axis=1, how="all")
+    values = p_value_df.to_numpy(dtype=np.float64)
 
-    p_value_df.dropna(axis=1, how="all", inplace=True)
+    reject, q_values = benjamini_hochberg(values, alpha=alpha)
 
-    # Create a dataframe of shape p_value_df with all NaN values
-    df_reject = pd.DataFrame(index=p_value_df.index, columns=p_value_df.columns)
+    codes = np.where(reject, REJECT_TRUE, REJECT_FALSE).astype(np.int8)
+    codes[np.isnan(values)] = REJECT_NAN
 
-    for i in p_value_df.columns:
-        tf_pval = p_value_df[i].dropna()
+    df_reject = pd.DataFrame(codes, index=p_value_df.index, columns=p_value_df.columns)
+    df_q_values = pd.DataFrame(q_values, index=p_value_df.index, columns=p_value_df.columns)
+    return df_reject, df_q_values
 
-        reject, pvals_corrected, _, _ = multipletests(
-            abs(tf_pval), alpha=alpha, method="fdr_bh"
-        )
 
-        tf_pval = pd.DataFrame(tf_pval)
-        tf_pval["Reject"] = reject
-        df_reject[i] = tf_pval["Reject"]
+def bh_correct_columns(p_values, columns, p_out, reject_out, q_out, alpha=0.05, block=BH_BLOCK_COLUMNS):
+    # Out of core version of bh_frd_correction for a (memory mapped) cells x TFs
+    # matrix: the columns at the given positions are read a block at a time and
+    # their p-values, reject codes and q-values are written to the next block
+    # of columns of the outputs, so memory holds at most cells x block values
+    for begin in range(0, len(columns), block):
+        end = min(begin + block, len(columns))
+        values = np.asarray(p_values[:, columns[begin:end]], dtype=np.float64)
+        reject, q_values = benjamini_hochberg(values, alpha=alpha)
 
-    return df_reject
+        codes = np.where(reject, REJECT_TRUE, REJECT_FALSE).astype(np.int8)
+        codes[np.isnan(values)] = REJECT_NAN
+        p_out[:, begin:end] = values
+        reject_out[:, begin:end] = codes
+        q_out[:, begin:end] = q_values
@@ -0,0 +1,132 @@
+import os
+
+import pandas as pd
+
+from app.utils import stage_cache
+from app.utils.matrix_io import ExpressionMatrix, read_expression_matrix
+from app.utils.orthologs import get_ortholog_index
+
+# Inputs of one session, parsed once per job. The UMAP pipeline and the TF
+# analysis both consume the same SessionDataset, so the expression matrix and
+# the metadata are read a single time and the TF p-values are computed on the
+# cells that pass the UMAP quality control. The parsed matrix is cached by
+# the content of the uploaded files, and the dataset carries the stage keys
+# (see stage_cache) its downstream stages are cached under.
+
+
+def read_session_meta_data(meta_data_path) -> pd.DataFrame:
+    # Cell names are normalized the same way R writes them in the data matrix
+    meta_data = pd.read_csv(meta_data_path, sep="\t", index_col=0)
+    meta_data.index = meta_data.index.str.replace(r"[ -]", ".", regex=True)
+    return meta_data
+
+
+def map_human_genes(genes) -> pd.Series:
+    # Human gene IDs of the mouse genes, indexed by the position of the mouse
+    # gene in genes. Only mapped genes are kept, and a gene mapping to several
+    # human genes appears once per human gene
+    gene_positions, human_ids = get_ortholog_index().map_genes(genes)
+    return pd.Series(human_ids, index=gene_positions, dtype=object)
+
+
+class SessionDataset:
+    def __init__(
+            self,
+            upload_dir,
+            data_matrix_filename: str,
+            meta_data_filename: str,
+            genes_filename: str = None,
+            cells_filename: str = None,
+    ):
+        self.upload_dir = upload_dir
+        data_matrix_path = os.path.join(upload_dir, data_matrix_filename)
+        meta_data_path = os.path.join(upload_dir, meta_data_filename)
+        if not os.path.isfile(meta_data_path):
+            raise FileNotFoundError(f"File not found: {meta_data_path}")
+
+        genes_path = os.path.join(upload_dir, genes_filename) if genes_filename else None
+        cells_path = os.path.join(upload_dir, cells_filename) if cells_filename else None
+        # The extension decides how the file is parsed
+        self.input_key = stage_cache.stage_key(
+            "parse",
+            stage_cache.file_key(data_matrix_path, genes_path, cells_path),
+            extension=data_matrix_filename.rsplit(".", 1)[-1].lower(),
+        )
+        expression = ExpressionMatrix.from_arrays(stage_cache.cached(
+            "parse",
+            self.input_key,
+            lambda: read_expression_matrix(data_matrix_path, genes_path=genes_path, cells_path=cells_path).arrays(),
+        ))
+        meta_data = read_session_meta_data(meta_data_path)
+        meta_data = meta_data[~meta_data.index.duplicated()]
+
+        # Match cells of the data matrix and the metadata
+        common_indices = expression.cells.intersection(meta_data.index)
+        self.expression: ExpressionMatrix = expression.subset_cells(common_indices)
+        self.meta_data = meta_data.loc[common_indices]
+
+        self.key = stage_cache.stage_key("match", self.input_key, cells=stage_cache.names_key(common_indices))
+
+        # Cells that passed quality control; all matched cells until apply_qc
+        self.cells = common_indices
+        self.qc_key = stage_cache.stage_key("qc", self.key, params=None)
+        self._qc = None
+        self._human_genes = None
+
+    @property
+    def genes(self):
+        return self.expression.genes
+
+    def apply_qc(
+            self,
+            filter_cells: str = "on",
+            filter_cells_value: int = 200,
+            filter_genes: str = "on",
+            filter_genes_value: int = 3,
+            qc_filter: str = "on",
+            qc_filter_value: float = 10,
+    ):
+        # Returns a fresh AnnData of the raw counts of the cells and genes that
+        # pass quality control and records the surviving cells. The filtered
+        # data is kept, so a second call with the same parameters is free
+        import scanpy as sc
+
+        params = (filter_cells, filter_cells_value, filter_genes, filter_genes_value, qc_filter, qc_filter_value)
+        self.qc_key = stage_cache.stage_key("qc", self.key, params=params)
+        if self._qc is not None and self._qc[0] == params:
+            return self._qc[1].copy()
+
+        adata = self.expression.to_anndata()
+        adata.obs = self.meta_data
+
+        # Filter cells and genes
+        print("Filtering and normalizing data...")
+        if filter_cells == "on":
+            sc.pp.filter_cells(adata, min_genes=filter_genes_value)
+        if filter_genes == "on":
+            sc.pp.filter_genes(adata, min_cells=filter_cells_value)
+
+        # Filter mitochondrial genes
+        print("Filtering mitochondrial genes...")
+        if qc_filter == "on":
+            adata.var["mt"] = adata.var_names.str.startswith("MT-")
+            sc.pp.calculate_qc_metrics(
+                adata, qc_vars=["mt"], percent_top=None, log1p=False, inplace=True
+            )
+            adata = adata[adata.obs.pct_counts_mt < qc_filter_value, :].copy()
+            del adata.var["mt"]
+
+        positions = self.expression.cells.astype(str).get_indexer(adata.obs_names)
+        self.cells = self.expression.cells[positions]
+        self._qc = (params, adata)
+        print(f"{len(self.cells)} of {self.expression.shape[0]} cells passed quality control")
+        return adata.copy()
+
+    def human_genes(self) -> pd.Series:
+        if self._human_genes is None:
+            self._human_genes = map_human_genes(self.genes)
+        return self._human_genes
+
+    def qc_expression(self) -> ExpressionMatrix:
+        # Expression of the cells that passed quality control
+        return self.expression.subset_cells(self.cells)
@@ -0,0 +1,31 @@
+import pandas as pd
+
+from app.utils import metrics, result_format, stage_cache, threads
+from app.utils.run_umap_pipeline import run_umap
+
+# Re-plotting of a finished session. The pipeline keeps the PCs and the
+# neighbors graph of every session (result_format.write_graph), so a new UMAP
+# embedding only runs sc.tl.umap on the stored graph, without the expression
+# matrix, quality control, normalization, PCA or the neighbor search.
+
+
+def reembed(job, upload_dir, min_dist: float):
+    # Background job: replaces the UMAP coordinates of the session
+    job.progress("umap", f"Re-running UMAP with min_dist={min_dist}")
+    sidecar, pcs, distances, connectivities = result_format.read_graph(upload_dir)
+
+    with metrics.stage("reembed", len(pcs), pcs.shape[1], job_id=job.id):
+        # Same key as the UMAP stage of the pipeline, so a min_dist used before is free
+        key = stage_cache.stage_key("umap", sidecar["neighbors_key"], min_dist=min_dist)
+        with threads.limit_threads(threads.UMAP_THREADS):
+            embedding = stage_cache.cached(
+                "umap",
+                key,
+                lambda: dict(X_umap=run_umap(pcs, distances, connectivities, sidecar["neighbors"], min_dist)),
+            )["X_umap"]
+
+    job.progress("write_umap", "Saving UMAP coordinates")
+    umap_df = result_format.read_umap(upload_dir)
+    embedding = pd.DataFrame(embedding, index=sidecar["rows"], columns=["X_umap1", "X_umap2"])
+    umap_df[embedding.columns] = embedding.reindex(umap_df.index).to_numpy()
+    result_format.write_umap(upload_dir, umap_df)
@@ -0,0 +1,166 @@
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+
+from app.extensions import socketio
+from app.utils import metrics
+
+# Local job queue for the analysis pipeline. Uploads are queued and processed
+# by a pool of background worker threads; every state change is pushed to the
+# Socket.IO room named after the job ID and can be polled through /jobs/<id>.
+# A job may also mirror its state into a status file so that other server
+# processes can report on it.
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Finished jobs are forgotten after this many seconds
+JOB_RETENTION = int(os.getenv("JOB_RETENTION", str(24 * 60 * 60)))
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_queue = queue.Queue()
+_workers = []
+_workers_lock = threading.Lock()
+
+
+class Job:
+    def __init__(self, func, args, kwargs, job_id=None, session_id=None, status_file=None):
+        self.id = job_id or str(uuid.uuid4())
+        self.session_id = session_id
+        self.status_file = status_file
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.state = QUEUED
+        self.stage = None
+        self.message = "Waiting in queue"
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "session_id": self.session_id,
+            "state": self.state,
+            "stage": self.stage,
+            "message": self.message,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+    def progress(self, stage, message):
+        print(f"Job {self.id}: [{stage}] {message}")
+        self.stage = stage
+        self.message = message
+        _publish(self)
+
+
+def _write_status(job: Job):
+    tmp_path = f"{job.status_file}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(job.to_dict(), f)
+    os.replace(tmp_path, job.status_file)
+
+
+def _publish(job: Job):
+    if job.status_file:
+        _write_status(job)
+    # Socket.IO is only available once the app has been created
+    if socketio.server is not None:
+        socketio.emit("job_progress", job.to_dict(), to=job.id)
+
+
+def _run(job: Job):
+    job.state = RUNNING
+    job.started = time.time()
+    job.progress("started", "Job started")
+    try:
+        with metrics.stage("job", job_id=job.id):
+            job.func(job, *job.args, **job.kwargs)
+    except Exception as e:
+        traceback.print_exc()
+        job.state = FAILED
+        job.error = str(e)
+        job.finished = time.time()
+        job.progress("failed", f"Job failed: {e}")
+    else:
+        job.state = DONE
+        job.finished = time.time()
+        job.progress("done", "Job finished")
+
+
+def _worker():
+    while True:
+        job = _queue.get()
+        try:
+            _run(job)
+        finally:
+            _queue.task_done()
+
+
+def _start_workers():
+    with _workers_lock:
+        while len(_workers) < JOB_WORKERS:
+            worker = threading.Thread(target=_worker, name=f"job-worker-{len(_workers)}", daemon=True)
+            worker.start()
+            _workers.append(worker)
+
+
+def _prune():
+    cutoff = time.time() - JOB_RETENTION
+    with _jobs_lock:
+        for job_id in [j.id for j in _jobs.values() if j.finished and j.finished < cutoff]:
+            del _jobs[job_id]
+
+
+def submit(func, *args, job_id=None, session_id=None, status_file=None, **kwargs) -> str:
+    # func is called as func(job, *args, **kwargs) on a worker thread and may
+    # report its stages through job.progress(stage, message)
+    _start_workers()
+    _prune()
+
+    job = Job(func, args, kwargs, job_id=job_id, session_id=session_id, status_file=status_file)
+    with _jobs_lock:
+        if job.id in _jobs:
+            raise ValueError(f"Job {job.id} already exists")
+        _jobs[job.id] = job
+    _publish(job)
+    _queue.put(job)
+    return job.id
+
+
+def get_job(job_id: str, status_file=None):
+    # Jobs of other processes are only known through their status file
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is not None:
+        return job.to_dict()
+    if status_file and os.path.isfile(status_file):
+        with open(status_file) as f:
+            return json.load(f)
+    return None
+
+
+def state_counts():
+    counts = {state: 0 for state in (QUEUED, RUNNING, DONE, FAILED)}
+    with _jobs_lock:
+        for job in _jobs.values():
+            counts[job.state] += 1
+    return counts
+
+
+def active_sessions():
+    with _jobs_lock:
+        return {j.session_id for j in _jobs.values() if j.session_id and j.state in (QUEUED, RUNNING)}
@@ -0,0 +1,135 @@
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import io as sio
+from scipy import sparse
+
+# Sparse loading of the uploaded expression matrix. The matrix is parsed once
+# into a cells x genes CSR matrix which both the UMAP and the TF analysis
+# consume. Zeros (and NaNs, which the TF analysis treats the same way) are
+# never stored.
+#
+# Supported uploads:
+#   .tsv / .txt / .csv  genes x cells text matrix, gene names in the first
+#                       column and cell names in the header; read in chunks
+#   .mtx                Matrix Market genes x cells matrix, with optional gene
+#                       and cell name files (one name per line, first column)
+#   .h5ad               AnnData file, cells x genes
+
+# Number of gene rows parsed at once from text matrices
+TEXT_CHUNK_ROWS = int(os.getenv("TEXT_CHUNK_ROWS", "2000"))
+
+MATRIX_EXTENSIONS = {"txt", "csv", "tsv", "mtx", "h5ad"}
+
+
+class ExpressionMatrix:
+    def __init__(self, matrix, cells, genes):
+        self.matrix = sparse.csr_matrix(matrix)  # cells x genes
+        self.matrix.eliminate_zeros()
+        self.cells = pd.Index(cells)
+        self.genes = pd.Index(genes)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        matrix = sparse.csr_matrix(
+            (arrays["data"], arrays["indices"], arrays["indptr"]), shape=tuple(arrays["shape"])
+        )
+        return cls(matrix, arrays["cells"], arrays["genes"])
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    def arrays(self) -> dict:
+        return dict(
+            data=self.matrix.data,
+            indices=self.matrix.indices,
+            indptr=self.matrix.indptr,
+            shape=np.array(self.matrix.shape),
+            cells=self.cells.to_numpy(dtype=str),
+            genes=self.genes.to_numpy(dtype=str),
+        )
+
+    def subset_cells(self, cells):
+        positions = self.cells.get_indexer(cells)
+        if (positions < 0).any():
+            raise KeyError("Cells not found in the expression matrix")
+        return ExpressionMatrix(self.matrix[positions], self.cells[positions], self.genes)
+
+    def to_anndata(self):
+        import anndata
+
+        return anndata.AnnData(
+            X=self.matrix.copy(),
+            obs=pd.DataFrame(index=self.cells.astype(str).rename(None)),
+            var=pd.DataFrame(index=self.genes.astype(str).rename(None)),
+        )
+
+
+def _extension(path):
+    return path.rsplit(".", 1)[-1].lower()
+
+
+def _sparse_chunk(chunk: pd.DataFrame, dtype):
+    values = chunk.to_numpy(dtype=dtype)
+    values[np.isnan(values)] = 0
+    return sparse.csr_matrix(values)
+
+
+def read_text_matrix(path, dtype=np.float32, chunk_rows=TEXT_CHUNK_ROWS) -> ExpressionMatrix:
+    sep = "," if _extension(path) == "csv" else "\t"
+    genes, chunks, cells = [], [], None
+    for chunk in pd.read_csv(path, sep=sep, index_col=0, chunksize=chunk_rows):
+        cells = chunk.columns if cells is None else cells
+        genes.append(chunk.index)
+        chunks.append(_sparse_chunk(chunk, dtype))
+
+    if cells is None:
+        raise ValueError(f"Empty expression matrix: {path}")
+
+    # Chunks are genes x cells; transposing the stacked CSR gives cells x genes
+    genes_by_cells = sparse.vstack(chunks, format="csr")
+    return ExpressionMatrix(genes_by_cells.T.tocsr(), cells, genes[0].append(genes[1:]))
+
+
+def _read_names(path, count, prefix):
+    if path is None:
+        return [f"{prefix}{i}" for i in range(count)]
+    names = pd.read_csv(path, sep="\t", header=None, usecols=[0])[0].astype(str)
+    if len(names) != count:
+        raise ValueError(f"{path} has {len(names)} names, expected {count}")
+    return names
+
+
+def read_mtx_matrix(path, genes_path=None, cells_path=None, dtype=np.float32) -> ExpressionMatrix:
+    genes_by_cells = sparse.csr_matrix(sio.mmread(path), dtype=dtype)
+    genes = _read_names(genes_path, genes_by_cells.shape[0], "gene_")
+    cells = _read_names(cells_path, genes_by_cells.shape[1], "cell_")
+    return ExpressionMatrix(genes_by_cells.T.tocsr(), cells, genes)
+
+
+def read_h5ad_matrix(path, dtype=np.float32) -> ExpressionMatrix:
+    import anndata
+
+    adata = anndata.read_h5ad(path)
+    matrix = adata.X if sparse.issparse(adata.X) else np.nan_to_num(adata.X)
+    return ExpressionMatrix(sparse.csr_matrix(matrix, dtype=dtype), adata.obs_names, adata.var_names)
+
+
+def read_expression_matrix(path, genes_path=None, cells_path=None, dtype=np.float32) -> ExpressionMatrix:
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"File not found: {path}")
+
+    print(f"Reading expression matrix: {path}")
+    extension = _extension(path)
+    if extension == "mtx":
+        expression = read_mtx_matrix(path, genes_path, cells_path, dtype=dtype)
+    elif extension == "h5ad":
+        expression = read_h5ad_matrix(path, dtype=dtype)
+    else:
+        expression = read_text_matrix(path, dtype=dtype)
+
+    print(f"Expression matrix: {expression.shape[0]} cells x {expression.shape[1]} genes, "
+          f"{expression.matrix.nnz} non-zero values")
+    return expression
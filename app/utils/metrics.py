@@ -0,0 +1,231 @@
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Stage instrumentation. Every pipeline stage runs inside metrics.stage(), which
+# measures wall time, CPU time and memory, and caches report hits and misses
+# through cache_event(). Each measurement is logged as one JSON event on the
+# "metrics" logger and aggregated in the process for the Prometheus text
+# format served on /metrics.
+#
+# The peak memory of a stage is the highest RSS of the process while it ran:
+# a sampler thread reads the RSS of the process every METRICS_SAMPLE_SECONDS,
+# and a rise of the process high water mark during the stage catches spikes
+# between two samples. CPU time is that of the whole process, so stages that
+# run side by side (the UMAP and TF branches, or two jobs) include each
+# other's CPU time; neither counts the TF worker processes.
+
+METRICS_LOG_LEVEL = os.getenv("METRICS_LOG_LEVEL", "INFO")
+METRICS_SAMPLE_SECONDS = float(os.getenv("METRICS_SAMPLE_SECONDS", "0.05"))
+
+# Upper bounds of the stage duration histogram, in seconds
+DURATION_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+logger = logging.getLogger("metrics")
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(METRICS_LOG_LEVEL)
+    logger.propagate = False
+
+_lock = threading.Lock()
+_stage_runs = defaultdict(int)
+_stage_failures = defaultdict(int)
+_stage_wall = defaultdict(float)
+_stage_cpu = defaultdict(float)
+_stage_buckets = defaultdict(lambda: [0] * len(DURATION_BUCKETS))
+_stage_last = {}
+_cache_events = defaultdict(int)
+_running = set()
+_sampler = None
+
+
+def memory_bytes():
+    # (current RSS, peak RSS) of the process
+    rss = peak = 0
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1]) * 1024
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return rss, peak
+
+
+def log_event(event: str, **fields):
+    logger.info(json.dumps({"event": event, "time": round(time.time(), 3), **fields}, default=str))
+
+
+def _sample_running():
+    while True:
+        time.sleep(METRICS_SAMPLE_SECONDS)
+        rss, _ = memory_bytes()
+        with _lock:
+            for current in _running:
+                current.peak = max(current.peak, rss)
+
+
+def _start_sampler():
+    global _sampler
+    with _lock:
+        if _sampler is None:
+            _sampler = threading.Thread(target=_sample_running, name="metrics-sampler", daemon=True)
+            _sampler.start()
+
+
+class Stage:
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.rows = None
+        self.cols = None
+        self.start_rss, self.start_hwm = memory_bytes()
+        self.peak = self.start_rss
+
+    def set(self, rows=None, cols=None):
+        # Size of the data the stage worked on, e.g. cells x genes
+        if rows is not None:
+            self.rows = int(rows)
+        if cols is not None:
+            self.cols = int(cols)
+
+
+@contextmanager
+def stage(name, rows=None, cols=None, **labels):
+    # Labels (e.g. job_id) only go into the log event, not into /metrics
+    _start_sampler()
+    current = Stage(name, **labels)
+    current.set(rows, cols)
+    with _lock:
+        _running.add(current)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    failed = False
+    try:
+        yield current
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        rss, hwm = memory_bytes()
+        with _lock:
+            _running.discard(current)
+            peak = max(current.peak, rss, hwm if hwm > current.start_hwm else 0)
+            _stage_runs[name] += 1
+            _stage_failures[name] += failed
+            _stage_wall[name] += wall
+            _stage_cpu[name] += cpu
+            buckets = _stage_buckets[name]
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if wall <= bound:
+                    buckets[i] += 1
+            _stage_last[name] = dict(
+                rss=rss, peak=peak, peak_delta=peak - current.start_rss, rows=current.rows, cols=current.cols
+            )
+        log_event(
+            "stage",
+            stage=name,
+            status="failed" if failed else "ok",
+            wall_seconds=round(wall, 4),
+            cpu_seconds=round(cpu, 4),
+            rss_bytes=rss,
+            peak_rss_bytes=peak,
+            peak_delta_bytes=peak - current.start_rss,
+            rows=current.rows,
+            cols=current.cols,
+            **labels,
+        )
+
+
+def cache_event(cache: str, hit: bool, **fields):
+    result = "hit" if hit else "miss"
+    with _lock:
+        _cache_events[(cache, result)] += 1
+    log_event("cache", cache=cache, result=result, **fields)
+
+
+def _line(name, labels, value):
+    label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+    return f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}"
+
+
+def render(extra_gauges=None) -> str:
+    # Prometheus text exposition format; extra_gauges maps a metric name to a
+    # (help, {label tuple: value}, label names) triple
+    with _lock:
+        lines = [
+            "# HELP tf_stage_runs_total Pipeline stage executions",
+            "# TYPE tf_stage_runs_total counter",
+            *(_line("tf_stage_runs_total", {"stage": s}, n) for s, n in _stage_runs.items()),
+            "# HELP tf_stage_failures_total Pipeline stage executions that raised",
+            "# TYPE tf_stage_failures_total counter",
+            *(_line("tf_stage_failures_total", {"stage": s}, n) for s, n in _stage_failures.items()),
+            "# HELP tf_stage_cpu_seconds_total CPU time of the server process while a stage ran",
+            "# TYPE tf_stage_cpu_seconds_total counter",
+            *(_line("tf_stage_cpu_seconds_total", {"stage": s}, round(v, 6)) for s, v in _stage_cpu.items()),
+            "# HELP tf_stage_wall_seconds Wall time of a stage",
+            "# TYPE tf_stage_wall_seconds histogram",
+        ]
+        for name, buckets in _stage_buckets.items():
+            for bound, count in zip(DURATION_BUCKETS, buckets):
+                lines.append(_line("tf_stage_wall_seconds_bucket", {"stage": name, "le": bound}, count))
+            lines.append(_line("tf_stage_wall_seconds_bucket", {"stage": name, "le": "+Inf"}, _stage_runs[name]))
+            lines.append(_line("tf_stage_wall_seconds_sum", {"stage": name}, round(_stage_wall[name], 6)))
+            lines.append(_line("tf_stage_wall_seconds_count", {"stage": name}, _stage_runs[name]))
+
+        for metric, key, help_text in (
+                ("tf_stage_last_rss_bytes", "rss", "Process RSS at the end of the last run of a stage"),
+                ("tf_stage_last_peak_rss_bytes", "peak", "Highest process RSS during the last run of a stage"),
+                ("tf_stage_last_peak_delta_bytes", "peak_delta",
+                 "Highest process RSS during the last run of a stage above the RSS at its start"),
+                ("tf_stage_last_rows", "rows", "Rows processed by the last run of a stage"),
+                ("tf_stage_last_cols", "cols", "Columns processed by the last run of a stage"),
+        ):
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+            lines += [
+                _line(metric, {"stage": s}, last[key])
+                for s, last in _stage_last.items()
+                if last[key] is not None
+            ]
+
+        lines += [
+            "# HELP tf_cache_requests_total Cache lookups by result",
+            "# TYPE tf_cache_requests_total counter",
+            *(
+                _line("tf_cache_requests_total", {"cache": cache, "result": result}, n)
+                for (cache, result), n in _cache_events.items()
+            ),
+        ]
+
+    for metric, (help_text, values, label_names) in (extra_gauges or {}).items():
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+        lines += [_line(metric, dict(zip(label_names, key)), value) for key, value in values.items()]
+
+    rss, peak = memory_bytes()
+    lines += [
+        "# HELP tf_process_rss_bytes Resident memory of the server process",
+        "# TYPE tf_process_rss_bytes gauge",
+        _line("tf_process_rss_bytes", {}, rss),
+        "# HELP tf_process_peak_rss_bytes Peak resident memory of the server process",
+        "# TYPE tf_process_peak_rss_bytes gauge",
+        _line("tf_process_peak_rss_bytes", {}, peak),
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        for values in (_stage_runs, _stage_failures, _stage_wall, _stage_cpu, _stage_buckets, _stage_last,
+                       _cache_events):
+            values.clear()
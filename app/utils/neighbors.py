@@ -0,0 +1,99 @@
+import importlib.util
+import os
+
+import numpy as np
+from scipy import sparse
+from sklearn.base import BaseEstimator, TransformerMixin
+
+# Neighbor search backends of the UMAP pipeline, passed to sc.pp.neighbors as
+# its transformer:
+#
+#   auto       scanpy's choice: exact below 4096 cells, NN-descent above
+#   exact      brute force search (sklearn)
+#   nndescent  approximate search with NN-descent (pynndescent)
+#   hnsw       approximate search in a local HNSW index, usually the fastest
+#              above ~50k cells; optional, only offered when hnswlib is
+#              installed (pip install hnswlib)
+#
+# The default comes from NEIGHBORS_BACKEND and a job can choose its own.
+
+BACKEND_LABELS = {
+    "auto": "auto",
+    "exact": "exact",
+    "nndescent": "NN-descent (approximate)",
+    "hnsw": "HNSW (approximate)",
+}
+
+# Backends that can run here
+NEIGHBORS_BACKENDS = tuple(
+    backend for backend in BACKEND_LABELS if backend != "hnsw" or importlib.util.find_spec("hnswlib") is not None
+)
+NEIGHBORS_BACKEND = os.getenv("NEIGHBORS_BACKEND", "auto")
+
+# HNSW index parameters: graph degree, and candidate list sizes for building
+# the index and for the queries (higher is more exact and slower)
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF = int(os.getenv("HNSW_EF", "100"))
+
+# Distances of the metrics HNSW supports, from the hnswlib space they are computed in
+HNSW_SPACES = {"euclidean": "l2", "cosine": "cosine"}
+
+
+class HnswTransformer(TransformerMixin, BaseEstimator):
+    # k nearest neighbors graph (each cell and its n_neighbors - 1 nearest
+    # cells, sorted by distance) as a sparse distance matrix, like
+    # pynndescent's PyNNDescentTransformer
+
+    def __init__(self, n_neighbors=15, metric="euclidean", n_jobs=1, random_state=0):
+        self.n_neighbors = n_neighbors
+        self.metric = metric
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def fit(self, X, y=None):
+        try:
+            import hnswlib
+        except ImportError:
+            raise ImportError("The hnsw neighbors backend needs hnswlib: pip install hnswlib") from None
+        if self.metric not in HNSW_SPACES:
+            raise ValueError(f"The hnsw neighbors backend does not support the {self.metric} metric")
+
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        self.index_ = hnswlib.Index(space=HNSW_SPACES[self.metric], dim=X.shape[1])
+        self.index_.init_index(
+            max_elements=len(X), ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M, random_seed=self.random_state
+        )
+        self.index_.set_num_threads(self.n_jobs)
+        self.index_.add_items(X, np.arange(len(X)))
+        self.n_samples_fit_ = len(X)
+        return self
+
+    def transform(self, X):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        k = min(self.n_neighbors, self.n_samples_fit_)
+        self.index_.set_ef(max(HNSW_EF, k))
+        labels, distances = self.index_.knn_query(X, k=k)
+        if self.metric == "euclidean":
+            # hnswlib's l2 space is the squared distance
+            distances = np.sqrt(np.maximum(distances, 0))
+        return sparse.csr_matrix(
+            (distances.ravel(), labels.ravel().astype(np.int64), np.arange(0, len(X) * k + 1, k)),
+            shape=(len(X), self.n_samples_fit_),
+        )
+
+    def fit_transform(self, X, y=None):
+        return self.fit(X).transform(X)
+
+
+def neighbors_transformer(backend: str, n_neighbors: int, metric: str, n_jobs: int = 1):
+    # Value of the transformer argument of sc.pp.neighbors
+    if backend == "auto":
+        return None
+    if backend == "exact":
+        return "sklearn"
+    if backend == "nndescent":
+        return "pynndescent"
+    if backend == "hnsw":
+        return HnswTransformer(n_neighbors=n_neighbors, metric=metric, n_jobs=n_jobs)
+    raise ValueError(f"Unknown neighbors backend: {backend}")
@@ -0,0 +1,192 @@
+import argparse
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from app.utils import metrics
+
+# Mouse to human ortholog index used to map uploaded mouse genes to the human
+# gene IDs of the prior network.
+#
+# The mapping table (columns "Mouse" and "Human", human IDs written as
+# "[ID1,ID2]") is compiled once into a few .npy files:
+#
+#   mouse.npy    sorted mouse symbols (fixed width unicode)
+#   offsets.npy  int64, human IDs of mouse[i] are targets[offsets[i]:offsets[i + 1]]
+#   targets.npy  int32 positions into human.npy
+#   human.npy    human gene IDs
+#   index.json   version and signature of the source table, written last
+#
+# The files are memory mapped and kept per process, so looking up genes costs
+# a binary search and a gather. Jobs never download anything; the table is
+# fetched and compiled ahead of time with
+#
+#   python -m app.utils.orthologs build
+
+INDEX_VERSION = 1
+
+UPLOAD_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads")
+
+ORTHOLOG_DIR = os.getenv("ORTHOLOG_DIR", os.path.join(UPLOAD_DIR, "orthologs"))
+ORTHOLOG_SOURCE = os.getenv("ORTHOLOG_SOURCE", os.path.join(UPLOAD_DIR, "mouse_to_human.tsv"))
+ORTHOLOG_URL = os.getenv("ORTHOLOG_URL", "https://www.cs.umb.edu/~kisan/data/mouse_to_human.tsv")
+
+INDEX_FILES = ["mouse", "offsets", "targets", "human"]
+
+_index = None
+_index_lock = threading.Lock()
+
+
+class OrthologIndex:
+    def __init__(self, index_dir=ORTHOLOG_DIR):
+        with open(os.path.join(index_dir, "index.json")) as f:
+            self.meta = json.load(f)
+        self.mouse, self.offsets, self.targets, self.human = (
+            np.load(os.path.join(index_dir, name + ".npy"), mmap_mode="r") for name in INDEX_FILES
+        )
+
+    def lookup(self, genes) -> np.ndarray:
+        # Position of every gene in the mouse symbols, -1 when not mapped
+        genes = np.asarray(pd.Index(genes).astype(str), dtype=str)
+        if len(self.mouse) == 0:
+            return np.full(len(genes), -1, dtype=np.int64)
+        positions = np.searchsorted(self.mouse, genes)
+        positions[positions == len(self.mouse)] = 0
+        return np.where(self.mouse[positions] == genes, positions, -1)
+
+    def map_genes(self, genes):
+        # Returns (gene_positions, human_ids): one entry per (gene, human ID)
+        # pair, in gene order
+        positions = self.lookup(genes)
+        found = np.flatnonzero(positions >= 0)
+        starts = self.offsets[positions[found]]
+        counts = self.offsets[positions[found] + 1] - starts
+
+        gene_positions = np.repeat(found, counts)
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        pairs = np.arange(counts.sum()) - first + np.repeat(starts, counts)
+        return gene_positions, self.human[self.targets[pairs]]
+
+
+def _source_signature(source):
+    stat = os.stat(source)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _is_current(index_dir, source):
+    try:
+        with open(os.path.join(index_dir, "index.json")) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if meta.get("version") != INDEX_VERSION:
+        return False
+    # Without the source table any compiled index is used as is
+    return not os.path.isfile(source) or meta.get("source") == _source_signature(source)
+
+
+@contextmanager
+def _locked(index_dir):
+    with open(os.path.join(index_dir, "index.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _atomic_write(path, write):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb" if path.endswith(".npy") else "w") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def compile_index(source=ORTHOLOG_SOURCE, index_dir=ORTHOLOG_DIR):
+    # Same rules as renaming the genes with dict(zip(Mouse, Human)): the last
+    # row of a mouse symbol wins, and only "[...]" values are mappings
+    table = pd.read_csv(source, sep="\t", usecols=["Mouse", "Human"], dtype=str)
+    table = table.dropna(subset=["Mouse"]).drop_duplicates("Mouse", keep="last")
+    table = table[table["Human"].str.match(r"^\[.*\]$", na=False)].sort_values("Mouse")
+
+    human_ids = table["Human"].str.strip("[]").str.split(",")
+    counts = human_ids.str.len().to_numpy()
+    flat = human_ids.explode().to_numpy(dtype=str)
+    human, targets = np.unique(flat, return_inverse=True)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    arrays = dict(
+        mouse=table["Mouse"].to_numpy(dtype=str),
+        offsets=offsets,
+        targets=targets.astype(np.int32),
+        human=human,
+    )
+    os.makedirs(index_dir, exist_ok=True)
+    for name in INDEX_FILES:
+        _atomic_write(os.path.join(index_dir, name + ".npy"), lambda f: np.save(f, arrays[name]))
+    meta = dict(version=INDEX_VERSION, source=_source_signature(source), mouse=len(table), human=len(human))
+    _atomic_write(os.path.join(index_dir, "index.json"), lambda f: json.dump(meta, f))
+    print(f"Compiled ortholog index: {len(table)} mouse genes, {len(human)} human genes")
+
+
+def get_ortholog_index() -> OrthologIndex:
+    global _index
+    with _index_lock:
+        if _index is not None and _is_current(ORTHOLOG_DIR, ORTHOLOG_SOURCE):
+            metrics.cache_event("ortholog_index", True, tier="memory")
+            return _index
+
+        if _is_current(ORTHOLOG_DIR, ORTHOLOG_SOURCE):
+            metrics.cache_event("ortholog_index", True, tier="disk")
+        else:
+            metrics.cache_event("ortholog_index", False)
+            if not os.path.isfile(ORTHOLOG_SOURCE):
+                raise FileNotFoundError(
+                    f"Ortholog index not found in {ORTHOLOG_DIR}; "
+                    "build it with: python -m app.utils.orthologs build"
+                )
+            os.makedirs(ORTHOLOG_DIR, exist_ok=True)
+            with _locked(ORTHOLOG_DIR):
+                # Another process may have compiled it while we waited for the lock
+                if not _is_current(ORTHOLOG_DIR, ORTHOLOG_SOURCE):
+                    compile_index()
+
+        _index = OrthologIndex(ORTHOLOG_DIR)
+        return _index
+
+
+def download(url=ORTHOLOG_URL, source=ORTHOLOG_SOURCE):
+    import requests
+
+    print(f"Downloading mouse to human mapping table from {url}")
+    response = requests.get(url)
+    response.raise_for_status()
+    os.makedirs(os.path.dirname(source), exist_ok=True)
+    _atomic_write(source, lambda f: f.write(response.text))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the mouse to human ortholog index")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = commands.add_parser("build", help="Download (if needed) and compile the mapping table")
+    build_parser.add_argument("--url", default=ORTHOLOG_URL)
+    build_parser.add_argument("--force-download", action="store_true")
+
+    args = parser.parse_args()
+    if args.command == "build":
+        if args.force_download or not os.path.isfile(ORTHOLOG_SOURCE):
+            download(args.url)
+        os.makedirs(ORTHOLOG_DIR, exist_ok=True)
+        with _locked(ORTHOLOG_DIR):
+            compile_index()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from app.utils import metrics
+from app.utils.benjamini_hotchberg import bh_correct_columns, bh_frd_correction
+from app.utils.dataset import SessionDataset
+from app.utils.result_format import (
+    commit_matrix,
+    create_matrix,
+    discard_matrix,
+    write_meta_data,
+    write_p_values,
+    write_q_values,
+    write_reject,
+    write_tf_summary,
+    write_tf_summary_matrix,
+    write_umap,
+)
+# from app.utils.tf_analysis import get_pvalues
+from app.utils.run_analysis import TF_STREAM_MIN_CELLS, get_pvalues, stream_pvalues
+from app.utils.run_umap_pipeline import run_umap_pipeline
+
+# UMAP parameters that belong to the quality control
+QC_PARAMS = ("filter_cells", "filter_cells_value", "filter_genes", "filter_genes_value", "qc_filter", "qc_filter_value")
+
+
+def run_pipeline(
+        job,
+        upload_dir: str,
+        data_matrix_filename: str,
+        meta_data_filename: str,
+        prior_data_filename: str,
+        umap_params: dict,
+        iters: int,
+        genes_filename: str = None,
+        cells_filename: str = None,
+):
+    # Background job: UMAP, TF analysis and Benjamini-Hochberg correction of one upload.
+    # The inputs are parsed once into a session dataset shared by both branches
+    job.progress("parse", "Reading expression matrix and metadata")
+    with metrics.stage("parse", job_id=job.id) as stage:
+        dataset = SessionDataset(
+            upload_dir, data_matrix_filename, meta_data_filename, genes_filename, cells_filename
+        )
+        stage.set(*dataset.expression.shape)
+
+    # Quality control decides the cells of both branches, so it runs first;
+    # the UMAP pipeline gets the memoized result
+    job.progress("qc", "Running quality control")
+    with metrics.stage("qc", job_id=job.id) as stage:
+        dataset.apply_qc(**{name: umap_params[name] for name in QC_PARAMS if name in umap_params})
+        stage.set(len(dataset.cells))
+    meta_data = dataset.meta_data.loc[dataset.cells]
+
+    def umap_branch():
+        with metrics.stage("umap_pipeline", job_id=job.id) as stage:
+            umap_df = run_umap_pipeline(
+                data_matrix_filename=data_matrix_filename,
+                meta_data_filename=meta_data_filename,
+                uuid_folder_name=os.path.basename(upload_dir),
+                dataset=dataset,
+                **umap_params,
+            )
+            stage.set(*umap_df.shape)
+        with metrics.stage("write_umap", rows=len(umap_df), job_id=job.id):
+            write_umap(upload_dir, umap_df)
+            write_meta_data(upload_dir, meta_data)
+        job.progress("umap_done", "UMAP pipeline finished")
+
+    # Large jobs stream the TF scores to disk instead of holding them in memory
+    streaming = len(dataset.cells) >= TF_STREAM_MIN_CELLS
+
+    def tf_branch():
+        if streaming:
+            with metrics.stage("tf_analysis", job_id=job.id) as stage:
+                streamed = stream_pvalues(prior_data_filename, data_matrix_filename, iters, upload_dir, dataset)
+                stage.set(len(streamed[1]), len(streamed[3]))
+            job.progress("tf_analysis_done", "TF analysis finished")
+            return streamed
+
+        with metrics.stage("tf_analysis", job_id=job.id) as stage:
+            p_values = get_pvalues(prior_data_filename, data_matrix_filename, iters, upload_dir, dataset=dataset)
+            stage.set(*p_values.shape)
+        with metrics.stage("write_p_values", *p_values.shape, job_id=job.id):
+            write_p_values(upload_dir, p_values)
+        job.progress("tf_analysis_done", "TF analysis finished")
+        return p_values
+
+    # The branches are independent and run side by side within the thread
+    # budgets of app.utils.threads; both finish before the correction
+    job.progress("umap_tf_analysis", "Running UMAP pipeline and TF analysis")
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix=f"job-{job.id}") as branches:
+        umap_future = branches.submit(umap_branch)
+        tf_future = branches.submit(tf_branch)
+    if streaming and umap_future.exception() is not None and tf_future.exception() is None:
+        discard_matrix(tf_future.result()[0])
+    umap_future.result()
+    if streaming:
+        write_streamed_results(job, upload_dir, *tf_future.result(), meta_data)
+        return
+    p_values = tf_future.result()
+
+    job.progress("bh_correction", "Running Benjamini-Hochberg FDR correction")
+    with metrics.stage("bh_correction", *p_values.shape, job_id=job.id):
+        reject, q_values = bh_frd_correction(p_values, alpha=0.05)
+    with metrics.stage("write_bh", *reject.shape, job_id=job.id):
+        write_reject(upload_dir, reject)
+        write_q_values(upload_dir, q_values)
+
+    # Counts for the TF list and the plot legends, written last
+    with metrics.stage("write_tf_summary", *reject.shape, job_id=job.id):
+        write_tf_summary(upload_dir, reject, p_values, meta_data)
+
+
+def write_streamed_results(job, upload_dir, raw_p_values, cells, tfs, columns, meta_data):
+    # The TFs with any p-value are corrected a block of columns at a time from
+    # the raw scores on disk into the p-value, reject and q-value results
+    tfs = tfs[columns]
+    shape = (len(cells), len(tfs))
+    job.progress("bh_correction", "Running Benjamini-Hochberg FDR correction")
+    with metrics.stage("bh_correction", *shape, job_id=job.id):
+        p_values = create_matrix(upload_dir, "p_values", shape, np.float32)
+        reject = create_matrix(upload_dir, "reject", shape, np.int8)
+        q_values = create_matrix(upload_dir, "q_values", shape, np.float32)
+        bh_correct_columns(raw_p_values, columns, p_values, reject, q_values, alpha=0.05)
+    with metrics.stage("write_bh", *shape, job_id=job.id):
+        for name, matrix in (("p_values", p_values), ("reject", reject), ("q_values", q_values)):
+            commit_matrix(upload_dir, name, matrix, cells, tfs)
+        discard_matrix(raw_p_values)
+
+    # Counts for the TF list and the plot legends, written last
+    with metrics.stage("write_tf_summary", *shape, job_id=job.id):
+        write_tf_summary_matrix(upload_dir, reject, p_values, cells, tfs, meta_data)
@@ -0,0 +1,99 @@
+import base64
+import os
+
+import numpy as np
+
+# Scatter trace payloads of the plot endpoints. Points are sent either as JSON
+# lists ("json", full precision) or as Plotly typed arrays ("binary": float32,
+# base64 encoded, about a fifth of the JSON size). Views with more than
+# PLOT_MAX_POINTS points are downsampled per trace, in proportion to the size
+# of the trace, so the picture keeps its density; the client asks again with
+# the visible x and y range on zoom and gets the points of that window at full
+# resolution once they fit the budget.
+
+PLOT_MAX_POINTS = int(os.getenv("PLOT_MAX_POINTS", "50000"))
+
+ENCODINGS = ("json", "binary")
+
+
+class PlotOptions:
+    def __init__(self, encoding="json", x_range=None, y_range=None, max_points=PLOT_MAX_POINTS):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown plot encoding: {encoding}")
+        self.encoding = encoding
+        self.x_range = _range(x_range)
+        self.y_range = _range(y_range)
+        self.max_points = max_points
+
+    @classmethod
+    def from_request(cls, data):
+        return cls(
+            encoding=data.get("encoding") or "json",
+            x_range=data.get("x_range"),
+            y_range=data.get("y_range"),
+        )
+
+
+def _range(value):
+    if value is None:
+        return None
+    low, high = (float(v) for v in value)
+    return min(low, high), max(low, high)
+
+
+def _in_range(values, value_range):
+    if value_range is None:
+        return np.ones(len(values), dtype=bool)
+    return (values >= value_range[0]) & (values <= value_range[1])
+
+
+def encode_array(values, encoding):
+    if encoding == "binary":
+        values = np.ascontiguousarray(values, dtype="<f4")
+        return {"dtype": "f4", "bdata": base64.b64encode(values.tobytes()).decode("ascii")}
+    return values.tolist()
+
+
+def sampling_priority(n_cells):
+    # Fixed random rank per cell; the lowest ranks are kept, so zooming in
+    # only ever adds points to the ones already shown
+    return np.random.default_rng(0).permutation(n_cells)
+
+
+def select_points(groups, x_values, y_values, options: PlotOptions):
+    # Positions of the points to send for each trace, from the sorted cell
+    # positions of its group, and whether any trace in view was downsampled
+    if options.x_range is not None or options.y_range is not None:
+        visible = _in_range(x_values, options.x_range) & _in_range(y_values, options.y_range)
+        groups = [positions[visible[positions]] for positions in groups]
+    total = sum(len(positions) for positions in groups)
+    if total <= options.max_points:
+        return groups, False
+
+    priority = sampling_priority(len(x_values))
+    fraction = options.max_points / total
+    sampled = []
+    for positions in groups:
+        keep = int(np.ceil(len(positions) * fraction))
+        if keep < len(positions):
+            lowest = np.argpartition(priority[positions], keep)[:keep]
+            positions = np.sort(positions[lowest])
+        sampled.append(positions)
+    return sampled, True
+
+
+def scatter_traces(x_values, y_values, categories, traces, options: PlotOptions):
+    # Fills "x" and "y" of the trace dict of every category; returns the
+    # traces and a summary of what was sent
+    groups = [categories.positions(code) for code in range(len(categories.labels))]
+    positions, downsampled = select_points(groups, x_values, y_values, options)
+    for trace, trace_positions in zip(traces, positions):
+        trace["x"] = encode_array(x_values[trace_positions], options.encoding)
+        trace["y"] = encode_array(y_values[trace_positions], options.encoding)
+    summary = {
+        "encoding": options.encoding,
+        "downsampled": downsampled,
+        "points": int(sum(len(p) for p in positions)),
+        "total_points": int(categories.counts.sum()),
+    }
+    return traces, summary
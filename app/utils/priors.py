@@ -0,0 +1,166 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from app.utils import metrics
+
+# Compiled prior networks. An uploaded prior network TSV (TF, action, target
+# per line) is compiled into CSR arrays grouped by TF:
+#
+#   tfs      sorted TF names
+#   offsets  int64, edges of tfs[i] are offsets[i]:offsets[i + 1]
+#   targets  int32 positions into genes, the target gene vocabulary
+#   signs    int8, 1 for upregulates-expression, -1 for downregulates-expression
+#
+# Compiled networks are cached by the SHA-256 of the uploaded file, so the
+# same prior uploaded again is never parsed twice. The scoring aligns the
+# vocabulary to the expression genes once per job and then works on the arrays.
+
+PRIOR_VERSION = 1
+
+PRIOR_CACHE_DIR = os.getenv(
+    "PRIOR_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads", "prior_cache"),
+)
+PRIOR_MEMORY_ENTRIES = 16
+
+ACTIONS = {"upregulates-expression": 1, "downregulates-expression": -1}
+
+_memory = OrderedDict()
+_memory_lock = threading.Lock()
+
+
+class PriorNetwork:
+    def __init__(self, tfs, offsets, targets, signs, genes):
+        self.tfs = pd.Index(tfs, name="tf")
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.targets = np.asarray(targets, dtype=np.int32)
+        self.signs = np.asarray(signs, dtype=np.int8)
+        self.genes = pd.Index(genes)
+
+    @classmethod
+    def from_edges(cls, tf, action, target):
+        # Edges are grouped by TF in sorted order, keeping the order of the
+        # edges of each TF, like groupby("tf").agg(list)
+        tfs, tf_codes = np.unique(np.asarray(tf, dtype=str), return_inverse=True)
+        order = np.argsort(tf_codes, kind="stable")
+        genes, targets = np.unique(np.asarray(target, dtype=str), return_inverse=True)
+        offsets = np.zeros(len(tfs) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(tf_codes, minlength=len(tfs)), out=offsets[1:])
+        return cls(tfs, offsets, targets[order], np.asarray(action)[order], genes)
+
+    @classmethod
+    def from_frame(cls, prior_network: pd.DataFrame):
+        # Accepts the "tf", "action", "target" edge list or the grouped frame
+        # with list valued "action" and "target" columns indexed by TF
+        if "tf" not in prior_network.columns:
+            prior_network = prior_network.explode(["action", "target"]).rename_axis("tf").reset_index()
+        return cls.from_edges(prior_network["tf"], prior_network["action"], prior_network["target"])
+
+    @property
+    def n_edges(self) -> np.ndarray:
+        # Total number of edges of each TF
+        return np.diff(self.offsets)
+
+    @property
+    def max_target(self) -> int:
+        return int(self.n_edges.max()) if len(self.tfs) else 0
+
+    def edge_tfs(self) -> np.ndarray:
+        # TF position of every edge
+        return np.repeat(np.arange(len(self.tfs)), self.n_edges)
+
+    def to_frame(self) -> pd.DataFrame:
+        # Grouped frame of the legacy scoring engine
+        actions = np.split(self.signs.astype(int), self.offsets[1:-1])
+        targets = np.split(self.genes.to_numpy()[self.targets], self.offsets[1:-1])
+        return pd.DataFrame(
+            {"action": [a.tolist() for a in actions], "target": [t.tolist() for t in targets]},
+            index=self.tfs,
+        )
+
+    def arrays(self) -> dict:
+        return dict(
+            tfs=self.tfs.to_numpy(dtype=str),
+            offsets=self.offsets,
+            targets=self.targets,
+            signs=self.signs,
+            genes=self.genes.to_numpy(dtype=str),
+        )
+
+
+def parse_prior(path) -> PriorNetwork:
+    prior_network = pd.read_csv(
+        path,
+        sep="\t",
+        header=None,
+        usecols=[0, 1, 2],
+        names=["tf", "action", "target"],
+        dtype=str,
+    )
+    prior_network["action"] = prior_network["action"].map(ACTIONS)
+    prior_network = prior_network.dropna()
+    return PriorNetwork.from_edges(
+        prior_network["tf"], prior_network["action"].astype(np.int8), prior_network["target"]
+    )
+
+
+def file_hash(path) -> str:
+    digest = hashlib.sha256(f"prior-v{PRIOR_VERSION}".encode())
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()[:32]
+
+
+def _remember(key, prior):
+    with _memory_lock:
+        _memory[key] = prior
+        _memory.move_to_end(key)
+        while len(_memory) > PRIOR_MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+
+
+def _atomic_save(path, prior: PriorNetwork):
+    fd, tmp_path = tempfile.mkstemp(dir=PRIOR_CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **prior.arrays())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_prior(path) -> PriorNetwork:
+    key = file_hash(path)
+    with _memory_lock:
+        prior = _memory.get(key)
+        if prior is not None:
+            _memory.move_to_end(key)
+    if prior is not None:
+        metrics.cache_event("prior_network", True, tier="memory")
+        return prior
+
+    cache_path = os.path.join(PRIOR_CACHE_DIR, key + ".npz")
+    try:
+        with np.load(cache_path) as arrays:
+            prior = PriorNetwork(**{name: arrays[name] for name in arrays.files})
+        print("Compiled prior network exists. Now we have to read it.")
+        metrics.cache_event("prior_network", True, tier="disk")
+    except (OSError, ValueError, KeyError, TypeError):
+        # Not compiled yet; two processes compiling the same file write the same arrays
+        print("Compiled prior network does not exist. Now we have to compile it.")
+        metrics.cache_event("prior_network", False)
+        prior = parse_prior(path)
+        os.makedirs(PRIOR_CACHE_DIR, exist_ok=True)
+        _atomic_save(cache_path, prior)
+
+    _remember(key, prior)
+    return prior
@@ -2,8 +2,14 @@ import os
 
 import pandas as pd
 
+from app.utils import result_format
+
+# Sessions written before the binary result format only have the text files
+
 
 def read_umap_coordinates_file(upload_dir):
+    if result_format.has_result(upload_dir, "umap"):
+        return result_format.read_umap(upload_dir)
     umap_data_path = os.path.join(upload_dir, "umap_coordinates.csv")
     print(f"Reading UMAP coordinates file: {umap_data_path}")
     umap_df = pd.read_csv(umap_data_path, index_col=0)
@@ -11,6 +17,8 @@ def read_umap_coordinates_file(upload_dir):
 
 
 def read_meta_data_file(upload_dir):
+    if result_format.has_result(upload_dir, "meta_data"):
+        return result_format.read_meta_data(upload_dir)
     meta_data_path = os.path.join(upload_dir, "meta_data.tsv")
     print(f"Reading meta data file: {meta_data_path}")
     meta_data = pd.read_csv(meta_data_path, sep="\t", index_col=0)
@@ -18,6 +26,8 @@ def read_meta_data_file(upload_dir):
 
 
 def read_pvalues_file(upload_dir):
+    if result_format.has_result(upload_dir, "p_values"):
+        return result_format.read_p_values(upload_dir)
     # p_value_path = os.path.join(upload_dir, "p_values_9k.tsv")
     p_value_path = os.path.join(upload_dir, "p_values.tsv")  # Hardcoded pvalues file
     print(f"Reading p-value file: {p_value_path}")
@@ -26,6 +36,8 @@ def read_pvalues_file(upload_dir):
 
 
 def read_bh_reject(upload_dir):
+    if result_format.has_result(upload_dir, "reject"):
+        return result_format.read_reject(upload_dir)
     # bh_reject_path = os.path.join(upload_dir, "reject_9k.tsv")
     bh_reject_path = os.path.join(upload_dir, "reject.tsv")
     print(f"Reading Benjamini-Hochberg reject file: {bh_reject_path}")
@@ -0,0 +1,383 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Binary session result format. Every result matrix is a .npy file in column
+# major order next to a JSON sidecar with its row and column labels, so a
+# single TF column can be read from a memory map without parsing the whole
+# cells x TFs matrix:
+#
+#   results/p_values.npy   float32 signed p-values, cells x TFs
+#   results/reject.npy     int8 Benjamini-Hochberg decisions, cells x TFs
+#                          (REJECT_TRUE, REJECT_FALSE or REJECT_NAN)
+#   results/q_values.npy   float32 Benjamini-Hochberg adjusted p-values
+#   results/umap.npy       float32 PCA and UMAP coordinates, cells x components
+#   results/clusters.npy   int32 codes into the "labels" of the umap sidecar
+#   results/meta_data.npy  int32 codes of the metadata columns of the cells,
+#                          into the per column "labels" of its sidecar
+#   results/pca.npy        float32 principal components the UMAP ran on, cells x
+#                          components; the sidecar has the neighbors parameters
+#   results/neighbors.npz  float32 CSR distances and connectivities of the
+#                          neighbors graph, cells x cells in the rows of pca.npy
+#   results/tf_summary.npy int32 cell counts per TF and status (TF_STATUSES)
+#   results/tf_cluster_counts.npy
+#                          int32 cell counts per TF, metadata category and
+#                          status; the categories of meta_data_columns[i] are
+#                          offsets[i]:offsets[i + 1] of the tf_summary sidecar.
+#                          Only columns with at most SUMMARY_MAX_CATEGORIES
+#                          categories are counted
+#
+# Large jobs fill p_values, reject and q_values in place through create_matrix
+# and commit_matrix instead of writing them from frames in memory.
+#
+# TSV/CSV versions are only produced on demand by export_table.
+
+FORMAT_VERSION = 1
+RESULTS_DIR = "results"
+
+# Tri-state codes of the Benjamini-Hochberg reject matrix
+REJECT_NAN = -1
+REJECT_FALSE = 0
+REJECT_TRUE = 1
+
+# Status of the cells for one TF, in legend order
+TF_STATUSES = ["Active", "Inactive", "Insignificant", "NaN"]
+
+# TFs counted at once for the per category counts of the TF summary
+SUMMARY_TF_CHUNK = 64
+
+# Metadata columns with more distinct values than this (e.g. nCount_RNA or
+# percent.mt, close to one value per cell) get no per category counts in the
+# TF summary; their counts are made on demand from the session index
+SUMMARY_MAX_CATEGORIES = int(os.getenv("SUMMARY_MAX_CATEGORIES", "200"))
+
+# Exportable tables and their legacy text file names
+EXPORTS = {
+    "p_values.tsv": "p_values",
+    "reject.tsv": "reject",
+    "q_values.tsv": "q_values",
+    "umap_coordinates.csv": "umap",
+}
+
+
+def results_dir(upload_dir):
+    return os.path.join(upload_dir, RESULTS_DIR)
+
+
+def result_path(upload_dir, name, extension=".npy"):
+    return os.path.join(results_dir(upload_dir), name + extension)
+
+
+def has_result(upload_dir, name):
+    return os.path.isfile(result_path(upload_dir, name, ".json"))
+
+
+def _labels(index):
+    return [label.item() if isinstance(label, np.generic) else label for label in index]
+
+
+def _write_matrix(upload_dir, name, values, rows, columns, **extra):
+    # The sidecar is written last and marks the matrix as complete
+    os.makedirs(results_dir(upload_dir), exist_ok=True)
+    path = result_path(upload_dir, name)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.asfortranarray(values))
+    os.replace(tmp_path, path)
+    _write_sidecar(upload_dir, name, rows, columns, **extra)
+
+
+def _write_sidecar(upload_dir, name, rows, columns, **extra):
+    sidecar = dict(version=FORMAT_VERSION, rows=_labels(rows), columns=_labels(columns), **extra)
+    sidecar_path = result_path(upload_dir, name, ".json")
+    with open(sidecar_path + ".tmp", "w") as f:
+        json.dump(sidecar, f)
+    os.replace(sidecar_path + ".tmp", sidecar_path)
+
+
+def create_matrix(upload_dir, name, shape, dtype) -> np.memmap:
+    # Writable column major memory map to fill in place, e.g. a chunk of cells
+    # at a time; it becomes the result name once commit_matrix is called
+    os.makedirs(results_dir(upload_dir), exist_ok=True)
+    return np.lib.format.open_memmap(
+        result_path(upload_dir, name) + ".tmp",
+        mode="w+",
+        dtype=dtype,
+        shape=tuple(int(n) for n in shape),
+        fortran_order=True,
+    )
+
+
+def commit_matrix(upload_dir, name, matrix: np.memmap, rows, columns, **extra):
+    matrix.flush()
+    os.replace(matrix.filename, result_path(upload_dir, name))
+    _write_sidecar(upload_dir, name, rows, columns, **extra)
+
+
+def discard_matrix(matrix: np.memmap):
+    # Removes a matrix of create_matrix that is not committed
+    if os.path.exists(matrix.filename):
+        os.remove(matrix.filename)
+
+
+def read_sidecar(upload_dir, name):
+    with open(result_path(upload_dir, name, ".json")) as f:
+        return json.load(f)
+
+
+def open_matrix(upload_dir, name):
+    # Returns (sidecar, memory mapped matrix); columns are contiguous on disk
+    return read_sidecar(upload_dir, name), np.load(result_path(upload_dir, name), mmap_mode="r")
+
+
+def write_p_values(upload_dir, p_values: pd.DataFrame):
+    _write_matrix(
+        upload_dir, "p_values", p_values.to_numpy(dtype=np.float32), p_values.index, p_values.columns
+    )
+
+
+def encode_reject(reject: pd.DataFrame) -> np.ndarray:
+    # Accepts tri-state codes as returned by bh_frd_correction or a frame of
+    # True / False / NaN values as in the TSV format
+    if all(dtype == np.int8 for dtype in reject.dtypes):
+        return reject.to_numpy()
+    codes = np.full(reject.shape, REJECT_NAN, dtype=np.int8)
+    codes[(reject == True).to_numpy()] = REJECT_TRUE  # noqa: E712
+    codes[(reject == False).to_numpy()] = REJECT_FALSE  # noqa: E712
+    return codes
+
+
+def write_reject(upload_dir, reject: pd.DataFrame):
+    _write_matrix(upload_dir, "reject", encode_reject(reject), reject.index, reject.columns)
+
+
+def write_q_values(upload_dir, q_values: pd.DataFrame):
+    _write_matrix(
+        upload_dir, "q_values", q_values.to_numpy(dtype=np.float32), q_values.index, q_values.columns
+    )
+
+
+def write_umap(upload_dir, umap_df: pd.DataFrame):
+    codes, labels = _factorize(umap_df["Cluster"])
+    os.makedirs(results_dir(upload_dir), exist_ok=True)
+    clusters_path = result_path(upload_dir, "clusters")
+    with open(clusters_path + ".tmp", "wb") as f:
+        np.save(f, codes)
+    os.replace(clusters_path + ".tmp", clusters_path)
+
+    coordinates = umap_df.drop(columns="Cluster")
+    _write_matrix(
+        upload_dir,
+        "umap",
+        coordinates.to_numpy(dtype=np.float32),
+        coordinates.index,
+        coordinates.columns,
+        labels=labels,
+    )
+
+
+def write_graph(upload_dir, cells, pcs, distances, connectivities, params: dict, neighbors_key: str):
+    # Everything the UMAP embedding needs, so it can be recomputed without the
+    # expression matrix; the pca sidecar is written last and marks both files
+    os.makedirs(results_dir(upload_dir), exist_ok=True)
+    graph = {}
+    for name, matrix in (("distances", distances), ("connectivities", connectivities)):
+        matrix = sparse.csr_matrix(matrix, dtype=np.float32)
+        graph.update({
+            f"{name}_data": matrix.data,
+            f"{name}_indices": matrix.indices.astype(np.int32),
+            f"{name}_indptr": matrix.indptr.astype(np.int64),
+            f"{name}_shape": np.array(matrix.shape),
+        })
+    graph_path = result_path(upload_dir, "neighbors", ".npz")
+    with open(graph_path + ".tmp", "wb") as f:
+        np.savez(f, **graph)
+    os.replace(graph_path + ".tmp", graph_path)
+
+    pcs = np.asarray(pcs, dtype=np.float32)
+    _write_matrix(
+        upload_dir,
+        "pca",
+        pcs,
+        cells,
+        [f"X_pca{i + 1}" for i in range(pcs.shape[1])],
+        neighbors=params,
+        neighbors_key=neighbors_key,
+    )
+
+
+def read_graph(upload_dir):
+    # Returns (sidecar, PCs, distances, connectivities)
+    sidecar, pcs = open_matrix(upload_dir, "pca")
+    with np.load(result_path(upload_dir, "neighbors", ".npz")) as graph:
+        distances, connectivities = (
+            sparse.csr_matrix(
+                (graph[f"{name}_data"], graph[f"{name}_indices"], graph[f"{name}_indptr"]),
+                shape=tuple(graph[f"{name}_shape"]),
+            )
+            for name in ("distances", "connectivities")
+        )
+    return sidecar, np.array(pcs), distances, connectivities
+
+
+def _factorize(values):
+    # Codes in order of first appearance; missing values get the label "NaN"
+    values = pd.Series(values, dtype=object)
+    codes, labels = pd.factorize(values.where(values.notna(), "NaN"))
+    return codes.astype(np.int32), _labels(labels)
+
+
+def write_meta_data(upload_dir, meta_data: pd.DataFrame):
+    codes = np.empty(meta_data.shape, dtype=np.int32)
+    labels = []
+    for i, column in enumerate(meta_data.columns):
+        codes[:, i], column_labels = _factorize(meta_data[column].to_numpy())
+        labels.append(column_labels)
+    _write_matrix(upload_dir, "meta_data", codes, meta_data.index, meta_data.columns, labels=labels)
+
+
+def tf_status_codes(reject, p_values) -> np.ndarray:
+    # Position in TF_STATUSES of every cell (and TF), from the reject codes and
+    # the signed p-values
+    codes = np.where(p_values < 0, 1, 0).astype(np.int8)
+    codes[reject == REJECT_FALSE] = 2
+    codes[reject == REJECT_NAN] = 3
+    return codes
+
+
+def write_tf_summary(upload_dir, reject: pd.DataFrame, p_values: pd.DataFrame, meta_data: pd.DataFrame):
+    write_tf_summary_matrix(
+        upload_dir,
+        encode_reject(reject),
+        p_values.reindex(index=reject.index, columns=reject.columns).to_numpy(dtype=np.float32),
+        reject.index,
+        reject.columns,
+        meta_data,
+    )
+
+
+def write_tf_summary_matrix(upload_dir, reject, p_values, cells, tfs, meta_data: pd.DataFrame):
+    # Status counts of every TF, in total and per category of every metadata
+    # column, so the plot endpoints never count over the cells x TFs matrix.
+    # reject (codes) and p_values are cells x TFs arrays or memory maps and are
+    # read SUMMARY_TF_CHUNK columns at a time
+    n_statuses = len(TF_STATUSES)
+    meta_data = meta_data.reindex(cells)
+    columns = {column: _factorize(meta_data[column].to_numpy()) for column in meta_data.columns}
+    columns = {
+        column: factorized for column, factorized in columns.items() if len(factorized[1]) <= SUMMARY_MAX_CATEGORIES
+    }
+    labels = [column_labels for _, column_labels in columns.values()]
+    offsets = np.concatenate([[0], np.cumsum([len(column_labels) for column_labels in labels])]).astype(int)
+
+    # The per category counts go straight to disk, a chunk of TFs at a time
+    os.makedirs(results_dir(upload_dir), exist_ok=True)
+    counts_path = result_path(upload_dir, "tf_cluster_counts")
+    totals = np.empty((len(tfs), n_statuses), dtype=np.int32)
+    cluster_counts = np.lib.format.open_memmap(
+        counts_path + ".tmp", mode="w+", dtype=np.int32, shape=(len(tfs), int(offsets[-1]), n_statuses)
+    )
+    for begin in range(0, len(tfs), SUMMARY_TF_CHUNK):
+        end = min(begin + SUMMARY_TF_CHUNK, len(tfs))
+        status = tf_status_codes(np.asarray(reject[:, begin:end]), np.asarray(p_values[:, begin:end]))
+        totals[begin:end] = np.stack([(status == i).sum(axis=0) for i in range(n_statuses)], axis=1)
+        for i, (codes, column_labels) in enumerate(columns.values()):
+            n_labels = len(column_labels)
+            # One bincount over (TF, category, status) keys for the chunk of TFs
+            keys = (np.arange(end - begin) * n_labels + codes[:, np.newaxis]) * n_statuses + status
+            cluster_counts[begin:end, offsets[i]:offsets[i + 1]] = np.bincount(
+                keys.ravel(), minlength=(end - begin) * n_labels * n_statuses
+            ).reshape(end - begin, n_labels, n_statuses)
+
+    cluster_counts.flush()
+    del cluster_counts
+    os.replace(counts_path + ".tmp", counts_path)
+
+    _write_matrix(
+        upload_dir,
+        "tf_summary",
+        totals,
+        tfs,
+        TF_STATUSES,
+        meta_data_columns=_labels(columns),
+        labels=labels,
+        offsets=offsets.tolist(),
+    )
+
+
+def read_tf_summary(upload_dir):
+    # Returns (sidecar, status counts TFs x TF_STATUSES, memory mapped counts
+    # TFs x categories x TF_STATUSES)
+    sidecar, totals = open_matrix(upload_dir, "tf_summary")
+    return sidecar, np.array(totals), np.load(result_path(upload_dir, "tf_cluster_counts"), mmap_mode="r")
+
+
+def read_column(upload_dir, name, column) -> pd.Series:
+    # Reads one column (e.g. one TF) without loading the rest of the matrix
+    sidecar, matrix = open_matrix(upload_dir, name)
+    position = sidecar["columns"].index(column)
+    return pd.Series(np.array(matrix[:, position]), index=sidecar["rows"], name=column)
+
+
+def read_p_values(upload_dir) -> pd.DataFrame:
+    sidecar, matrix = open_matrix(upload_dir, "p_values")
+    return pd.DataFrame(np.array(matrix), index=sidecar["rows"], columns=sidecar["columns"])
+
+
+def read_q_values(upload_dir) -> pd.DataFrame:
+    sidecar, matrix = open_matrix(upload_dir, "q_values")
+    return pd.DataFrame(np.array(matrix), index=sidecar["rows"], columns=sidecar["columns"])
+
+
+def read_reject(upload_dir) -> pd.DataFrame:
+    # Decoded back to the True / False / NaN frame of the TSV format
+    sidecar, matrix = open_matrix(upload_dir, "reject")
+    reject = np.full(matrix.shape, np.nan, dtype=object)
+    reject[matrix == REJECT_TRUE] = True
+    reject[matrix == REJECT_FALSE] = False
+    return pd.DataFrame(reject, index=sidecar["rows"], columns=sidecar["columns"])
+
+
+def read_meta_data(upload_dir) -> pd.DataFrame:
+    sidecar, codes = open_matrix(upload_dir, "meta_data")
+    meta_data = pd.DataFrame(index=sidecar["rows"])
+    for i, column in enumerate(sidecar["columns"]):
+        labels = np.asarray(sidecar["labels"][i], dtype=object)
+        labels[labels == "NaN"] = np.nan
+        meta_data[column] = labels[codes[:, i]]
+    return meta_data
+
+
+def read_umap(upload_dir) -> pd.DataFrame:
+    sidecar, matrix = open_matrix(upload_dir, "umap")
+    umap_df = pd.DataFrame(np.array(matrix), index=sidecar["rows"], columns=sidecar["columns"])
+    codes = np.load(result_path(upload_dir, "clusters"))
+    umap_df["Cluster"] = np.asarray(sidecar["labels"], dtype=object)[codes]
+    return umap_df
+
+
+def export_table(upload_dir, file_name) -> str:
+    # Writes the legacy text version of a result next to the binary one and
+    # returns its path; the export is reused until the result changes
+    name = EXPORTS[file_name]
+    export_dir = os.path.join(upload_dir, "exports")
+    export_path = os.path.join(export_dir, file_name)
+    source_path = result_path(upload_dir, name, ".json")
+    if os.path.isfile(export_path) and os.path.getmtime(export_path) >= os.path.getmtime(source_path):
+        return export_path
+
+    os.makedirs(export_dir, exist_ok=True)
+    if name == "p_values":
+        table, sep = read_p_values(upload_dir), "\t"
+    elif name == "q_values":
+        table, sep = read_q_values(upload_dir), "\t"
+    elif name == "reject":
+        table, sep = read_reject(upload_dir), "\t"
+    else:
+        table, sep = read_umap(upload_dir), ","
+    table.to_csv(export_path + ".tmp", sep=sep)
+    os.replace(export_path + ".tmp", export_path)
+    return export_path
@@ -0,0 +1,265 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from app.utils import metrics, result_format
+from app.utils.read_data import (
+    read_umap_coordinates_file,
+    read_meta_data_file,
+    read_pvalues_file,
+    read_bh_reject,
+)
+from app.utils.result_format import REJECT_NAN, REJECT_TRUE, TF_STATUSES
+
+# In-memory store of session results for the plot endpoints. The result files
+# of a session are parsed once into typed arrays and kept in an LRU cache
+# bounded by RESULT_CACHE_MAX_BYTES; an entry is reloaded as soon as one of
+# its files changes on disk.
+
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(1024 ** 3)))
+
+RESULT_FILES = [
+    os.path.join(result_format.RESULTS_DIR, "umap.json"),
+    os.path.join(result_format.RESULTS_DIR, "p_values.json"),
+    os.path.join(result_format.RESULTS_DIR, "reject.json"),
+    os.path.join(result_format.RESULTS_DIR, "meta_data.json"),
+    os.path.join(result_format.RESULTS_DIR, "tf_summary.json"),
+    "umap_coordinates.csv",
+    "meta_data.tsv",
+    "p_values.tsv",
+    "reject.tsv",
+]
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class Categories:
+    # Categorical column as integer codes into a list of labels (in order of
+    # first appearance, missing values labelled "NaN"), indexed by category:
+    # the cells of labels[i] are order[offsets[i]:offsets[i + 1]], in cell order
+
+    def __init__(self, codes, labels):
+        self.codes = np.asarray(codes, dtype=np.int32)
+        self.labels = list(labels)
+        self.order = np.argsort(self.codes, kind="stable").astype(np.int32)
+        self.offsets = np.zeros(len(self.labels) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.codes, minlength=len(self.labels)), out=self.offsets[1:])
+
+    @classmethod
+    def from_values(cls, values):
+        codes, labels = pd.factorize(pd.Series(values, dtype=object).fillna("NaN"))
+        return cls(codes, labels.tolist())
+
+    def positions(self, code):
+        return self.order[self.offsets[code]:self.offsets[code + 1]]
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.order.nbytes + self.offsets.nbytes
+
+
+def _align(rows, matrix, cells, fill):
+    # Rows of matrix reordered to cells; cells missing from rows get fill
+    positions = pd.Index(rows).get_indexer(cells)
+    aligned = np.full((len(cells), matrix.shape[1]), fill, dtype=matrix.dtype)
+    found = positions >= 0
+    aligned[found] = matrix[positions[found]]
+    return aligned
+
+
+class SessionResult:
+    def __init__(self, upload_dir):
+        if result_format.has_result(upload_dir, "umap"):
+            sidecar, coordinates = result_format.open_matrix(upload_dir, "umap")
+            self.cells = pd.Index(sidecar["rows"])
+            self.coordinates = {
+                column: np.array(coordinates[:, i]) for i, column in enumerate(sidecar["columns"])
+            }
+            codes = np.load(result_format.result_path(upload_dir, "clusters"))
+            self.cluster = Categories(codes, sidecar["labels"])
+        else:
+            umap_data = read_umap_coordinates_file(upload_dir)
+            self.cells = umap_data.index
+            self.coordinates = {
+                column: umap_data[column].to_numpy(dtype=np.float32)
+                for column in umap_data.columns
+                if column != "Cluster"
+            }
+            self.cluster = Categories.from_values(umap_data["Cluster"])
+
+        if result_format.has_result(upload_dir, "meta_data"):
+            # Already encoded per column by the pipeline
+            sidecar, codes = result_format.open_matrix(upload_dir, "meta_data")
+            codes = _align(sidecar["rows"], codes, self.cells, -1)
+            self.meta_data_columns = sidecar["columns"]
+            self.meta_data = {}
+            for i, column in enumerate(self.meta_data_columns):
+                labels = list(sidecar["labels"][i])
+                column_codes = codes[:, i]
+                if (column_codes < 0).any():
+                    # Cells without metadata
+                    if "NaN" not in labels:
+                        labels.append("NaN")
+                    column_codes = np.where(column_codes < 0, labels.index("NaN"), column_codes)
+                self.meta_data[column] = Categories(column_codes, labels)
+        else:
+            # Metadata cell names are normalized the same way as in the UMAP pipeline
+            meta_data = read_meta_data_file(upload_dir)
+            meta_data.index = meta_data.index.str.replace(r"[ -]", ".", regex=True)
+            meta_data = meta_data[~meta_data.index.duplicated()].reindex(self.cells)
+            self.meta_data_columns = meta_data.columns.tolist()
+            self.meta_data = {
+                column: Categories.from_values(meta_data[column]) for column in self.meta_data_columns
+            }
+
+        if result_format.has_result(upload_dir, "reject"):
+            sidecar, reject = result_format.open_matrix(upload_dir, "reject")
+            reject_rows = sidecar["rows"]
+            self.tfs = sidecar["columns"]
+        else:
+            bh_reject = read_bh_reject(upload_dir)
+            reject_rows = bh_reject.index
+            self.tfs = bh_reject.columns.tolist()
+            reject = result_format.encode_reject(bh_reject)
+        self.reject = _align(reject_rows, reject, self.cells, REJECT_NAN)
+
+        if result_format.has_result(upload_dir, "p_values"):
+            sidecar, p_values = result_format.open_matrix(upload_dir, "p_values")
+            p_values = pd.DataFrame(p_values, index=sidecar["rows"], columns=sidecar["columns"])
+        else:
+            p_values = read_pvalues_file(upload_dir)
+        p_values = p_values.reindex(columns=self.tfs)
+        self.p_values = _align(p_values.index, p_values.to_numpy(dtype=np.float32), self.cells, np.nan)
+
+        self._tf_positions = {tf: i for i, tf in enumerate(self.tfs)}
+        if result_format.has_result(upload_dir, "tf_summary"):
+            # Counted by the pipeline; the plot endpoints only look them up
+            sidecar, totals, cluster_counts = result_format.read_tf_summary(upload_dir)
+            positions = pd.Index(sidecar["rows"]).get_indexer(self.tfs)
+            self.status_counts = totals[positions]
+            self.summary = sidecar
+            self._summary_rows = positions
+            self._cluster_counts = cluster_counts
+        else:
+            # Sessions from before the TF summary
+            self.status_counts = None
+            self.summary = None
+        self.significant_counts = (
+            (self.reject == REJECT_TRUE).sum(axis=0)
+            if self.status_counts is None
+            else self.status_counts[:, 0] + self.status_counts[:, 1]
+        )
+        # Per TF status index, built the first time a TF is plotted; indexing
+        # every TF up front would take an int32 per cell and TF
+        self._tf_status = {}
+
+    def tf_column(self, tf_name):
+        return self._tf_positions[tf_name]
+
+    def tf_status(self, tf_name) -> Categories:
+        status = self._tf_status.get(tf_name)
+        if status is None:
+            tf_column = self.tf_column(tf_name)
+            codes = result_format.tf_status_codes(self.reject[:, tf_column], self.p_values[:, tf_column])
+            status = self._tf_status[tf_name] = Categories(codes, TF_STATUSES)
+        return status
+
+    def tf_status_counts(self, tf_name) -> np.ndarray:
+        # Cells per status of the TF, in TF_STATUSES order
+        if self.status_counts is not None:
+            return self.status_counts[self.tf_column(tf_name)]
+        return self.tf_status(tf_name).counts
+
+    @property
+    def summary_columns(self):
+        # Metadata columns of the TF summary: those with few enough categories
+        if self.summary is not None:
+            return self.summary["meta_data_columns"]
+        return [
+            column for column in self.meta_data_columns
+            if len(self.meta_data[column].labels) <= result_format.SUMMARY_MAX_CATEGORIES
+        ]
+
+    def tf_cluster_counts(self, tf_name, column) -> dict:
+        # Cells per status of the TF in every category of a metadata column;
+        # columns outside the stored summary are counted from the status index
+        if self.summary is not None and column in self.summary["meta_data_columns"]:
+            position = self.summary["meta_data_columns"].index(column)
+            labels = self.summary["labels"][position]
+            begin, end = self.summary["offsets"][position], self.summary["offsets"][position + 1]
+            counts = self._cluster_counts[self._summary_rows[self.tf_column(tf_name)], begin:end]
+        else:
+            categories = self.meta_data[column]
+            labels = categories.labels
+            status = self.tf_status(tf_name)
+            counts = np.bincount(
+                categories.codes * len(TF_STATUSES) + status.codes,
+                minlength=len(labels) * len(TF_STATUSES),
+            ).reshape(len(labels), len(TF_STATUSES))
+        return {
+            label: dict(zip(TF_STATUSES, label_counts.tolist())) for label, label_counts in zip(labels, counts)
+        }
+
+    @property
+    def nbytes(self):
+        return (
+            sum(values.nbytes for values in self.coordinates.values())
+            + self.cluster.nbytes
+            + sum(categories.nbytes for categories in self.meta_data.values())
+            + self.reject.nbytes
+            + self.p_values.nbytes
+            + sum(status.nbytes for status in list(self._tf_status.values()))
+        )
+
+
+def _file_signature(upload_dir):
+    signature = []
+    for name in RESULT_FILES:
+        try:
+            stat = os.stat(os.path.join(upload_dir, name))
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def get_session_result(upload_dir) -> SessionResult:
+    signature = _file_signature(upload_dir)
+    with _cache_lock:
+        entry = _cache.get(upload_dir)
+        if entry is not None and entry[0] == signature:
+            _cache.move_to_end(upload_dir)
+            result = entry[1]
+        else:
+            result = None
+    metrics.cache_event("session_result", result is not None)
+    if result is not None:
+        return result
+
+    print(f"Loading session result: {upload_dir}")
+    with metrics.stage("load_session_result") as stage:
+        result = SessionResult(upload_dir)
+        stage.set(len(result.cells), len(result.tfs))
+
+    with _cache_lock:
+        _cache[upload_dir] = (signature, result)
+        _cache.move_to_end(upload_dir)
+        total = sum(entry[1].nbytes for entry in _cache.values())
+        # Evict least recently used sessions, but always keep the one just loaded
+        while total > RESULT_CACHE_MAX_BYTES and len(_cache) > 1:
+            _, (_, evicted) = _cache.popitem(last=False)
+            total -= evicted.nbytes
+    return result
+
+
+def invalidate(upload_dir):
+    with _cache_lock:
+        _cache.pop(upload_dir, None)
@@ -2,15 +2,33 @@ import os
 import pandas as pd
 import numpy as np
 from scipy.stats import zscore
-import requests
 from scipy.special import erf
 from joblib import Parallel, delayed
 
+from app.utils import metrics, sd_cache, stage_cache
+from app.utils.dataset import SessionDataset, map_human_genes
+from app.utils.matrix_io import read_expression_matrix
+from app.utils.orthologs import get_ortholog_index
+from app.utils.priors import PriorNetwork, file_hash, load_prior
+from app.utils.result_format import create_matrix, discard_matrix
+from app.utils.scoring import build_incidence, duplicate_groups, sparse_gene_stats
+from app.utils.worker_pool import score_cells
+
 # This is using all n's and k's
 
 # Path to the "uploads" folder (use absolute path for robustness)
 UPLOAD_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads")
 
+# Upper bound of random keys drawn at once by simulate_distribution (~32 MB)
+SIMULATION_CHUNK_VALUES = 4_000_000
+
+# Jobs with at least TF_STREAM_MIN_CELLS cells are scored in streaming mode:
+# TF_STREAM_CHUNK_CELLS cells at a time are densified and scored, and their
+# p-values go straight to a memory mapped matrix in the session results, so
+# memory is bounded by the chunk instead of the number of cells
+TF_STREAM_MIN_CELLS = int(os.getenv("TF_STREAM_MIN_CELLS", "50000"))
+TF_STREAM_CHUNK_CELLS = int(os.getenv("TF_STREAM_CHUNK_CELLS", "4096"))
+
 
 def distribution_worker(max_target: int, ranks: np.array):
     arr = np.zeros(max_target)
@@ -21,27 +39,44 @@ def distribution_worker(max_target: int, ranks: np.array):
     return arr
 
 
-def get_sd(max_target: int, total_genes: int, iters: int):
-    sd_file = f"SD_anal_{max_target}_{total_genes}_{iters}.npz"
-    sd_file = os.path.join(UPLOAD_DIR, sd_file)
+def simulate_distribution(max_target: int, total_genes: int, iters: int, rng=None):
+    # Vectorized version of distribution_worker: a chunk of iterations is drawn
+    # at once by taking the max_target smallest of n random keys per row (a
+    # uniform ordered sample without replacement), and the SD of the min-folded
+    # average rank is accumulated chunk by chunk
+    rng = np.random.default_rng() if rng is None else rng
+    ranks = np.linspace(start=1, stop=total_genes, num=total_genes)
+    ranks = (ranks - 0.5) / total_genes
+    counts = np.arange(1, max_target + 1)
 
-    if os.path.isfile(sd_file):
-        print("Distribution file exists. Now we have to read it.")
-        return np.load(sd_file)["distribution"]
+    chunk = max(1, SIMULATION_CHUNK_VALUES // total_genes)
+    n, mean, m2 = 0, np.zeros(max_target), np.zeros(max_target)
+    for start in range(0, iters, chunk):
+        size = min(chunk, iters - start)
+        keys = rng.random((size, total_genes))
+        picked = np.argpartition(keys, max_target - 1, axis=1)[:, :max_target]
+        order = np.argsort(np.take_along_axis(keys, picked, axis=1), axis=1)
+        picked = np.take_along_axis(picked, order, axis=1)
 
-    print("Distribution file does not exist. Now we have to generate it.")
+        amr = ranks[picked].cumsum(axis=1) / counts
+        amr = np.minimum(amr, 1 - amr)
 
-    # n = 10_000  # Sampling size for random distribution
-    # n = total_genes  # Sampling size for random distribution
-    ranks = np.linspace(start=1, stop=total_genes, num=total_genes)
-    ranks = (ranks - 0.5) / total_genes
+        # Chan et al. parallel update of the running mean and sum of squares
+        chunk_mean = amr.mean(axis=0)
+        chunk_m2 = ((amr - chunk_mean) ** 2).sum(axis=0)
+        delta = chunk_mean - mean
+        total = n + size
+        mean = mean + delta * size / total
+        m2 = m2 + chunk_m2 + delta ** 2 * n * size / total
+        n = total
+
+    return np.sqrt(m2 / n)
 
-    dist = Parallel(n_jobs=-1, verbose=5, backend="multiprocessing")(
-        delayed(distribution_worker)(max_target, ranks) for _ in range(iters)
+
+def get_sd(max_target: int, total_genes: int, iters: int):
+    return sd_cache.get_distribution(
+        "min_folded", max_target, total_genes, iters, simulate_distribution
     )
-    dist = np.std(np.array(dist).T, axis=1)
-    np.savez_compressed(file=sd_file, distribution=dist)
-    return dist
 
 
 def sample_worker(
@@ -104,119 +139,182 @@ def sample_worker(
 def run_analysis(
         tfs,
         gene_exp: pd.DataFrame,
-        prior_network: pd.DataFrame,
+        prior_network: PriorNetwork,
         distribution: np.array,
         iters: int,
+        engine: str = "vectorized",
 ) -> pd.DataFrame:
-    gene_exp = gene_exp.T
-    parallel = Parallel(n_jobs=-1, verbose=5, backend="multiprocessing")
-    output = parallel(
-        delayed(sample_worker)(pd.DataFrame(row), prior_network, distribution, iters)
-        for idx, row in gene_exp.iterrows()
-    )
-    output = pd.DataFrame(output, columns=tfs, index=gene_exp.index)
+    # gene_exp is genes x cells with the raw expression values
+    if engine == "vectorized":
+        incidence = build_incidence(prior_network, gene_exp.index)
+        groups = duplicate_groups(gene_exp.index)
+        with metrics.stage("scoring", gene_exp.shape[1], len(tfs)):
+            output = score_cells(gene_exp.to_numpy(dtype=np.float64), incidence, distribution, groups)
+    elif engine == "legacy":
+        grouped = prior_network.to_frame()
+        z_scores = gene_exp.apply(zscore, axis=1, nan_policy="omit")
+        parallel = Parallel(n_jobs=-1, verbose=5, backend="multiprocessing")
+        output = parallel(
+            delayed(sample_worker)(pd.DataFrame(row), grouped, distribution, iters)
+            for idx, row in z_scores.T.iterrows()
+        )
+    else:
+        raise ValueError(f"Unknown scoring engine: {engine}")
+
+    output = pd.DataFrame(output, columns=tfs, index=gene_exp.columns)
     return output
 
 
-def main(prior_network: pd.DataFrame, gene_exp: pd.DataFrame, iters: int):
-    gene_exp = gene_exp.apply(zscore, axis=1, nan_policy="omit")
-
-    # Grouping prior_network network
-    prior_network = prior_network.groupby("tf").agg({"action": list, "target": list})
-    prior_network["updown"] = prior_network["target"].apply(lambda x: len(x))
+def main(prior_network, gene_exp: pd.DataFrame, iters: int, engine: str = "vectorized"):
+    # prior_network is a compiled PriorNetwork or a "tf", "action", "target" frame.
+    # The expression values are z-scored per gene by the scoring engine
+    if not isinstance(prior_network, PriorNetwork):
+        prior_network = PriorNetwork.from_frame(prior_network)
 
-    max_target = np.max(prior_network["updown"])
-    distribution = get_sd(
-        max_target=max_target,
-        total_genes=len(gene_exp),
-        iters=iters,
-    )
+    with metrics.stage("sd_table", prior_network.max_target, len(gene_exp)):
+        distribution = get_sd(
+            max_target=prior_network.max_target,
+            total_genes=len(gene_exp),
+            iters=iters,
+        )
 
     return run_analysis(
-        tfs=prior_network.index,
+        tfs=prior_network.tfs,
         gene_exp=gene_exp,
         prior_network=prior_network,
         distribution=distribution,
         iters=iters,
+        engine=engine,
     )
 
 
-def read_mouse_to_human_mapping_file():
-    mth_file = "mouse_to_human.tsv"
-    mth_file_path = os.path.join(UPLOAD_DIR, mth_file)
+def read_sparse_data(p_file: str, g_file: str, upload_dir, dataset: SessionDataset = None):
+    # Returns the prior network, the cells x genes sparse matrix of the
+    # measured human genes, their gene IDs and the cells
 
-    if os.path.isfile(mth_file_path):
-        print("Mouse to human mapping file exists. Let's read")
-        return pd.read_csv(mth_file_path, sep="\t")
+    # Compiled once per distinct prior network file
+    prior_network = load_prior(os.path.join(upload_dir, p_file))
 
-    print("Mouse to human mapping file does not exist. Let's download it.\n")
-    file_url = "https://www.cs.umb.edu/~kisan/data/mouse_to_human.tsv"
+    # The session dataset has the cells that passed the UMAP quality control
+    # and the human gene IDs already mapped, otherwise read the matrix here
+    if dataset is not None:
+        expression = dataset.qc_expression()
+        names = dataset.human_genes()
+    else:
+        expression = read_expression_matrix(os.path.join(upload_dir, g_file))
+        names = map_human_genes(expression.genes)
 
-    try:
-        response = requests.get(file_url)
-        with open(mth_file_path, "wb") as f:
-            f.write(response.content)
-        print("Mouse to human mapping file downloaded successfully.")
-
-    except requests.exceptions.RequestException as e:
-        print(f"Failed to download the mouse to human map file: {e}")
-        raise Exception(f"Failed to download the mouse to human map file: {e}")
-
-    return pd.read_csv(mth_file_path, sep="\t")
-
-
-def read_data(p_file: str, g_file: str, upload_dir):
-    p_file_path = os.path.join(upload_dir, p_file)
-
-    prior_network = pd.read_csv(
-        p_file_path,
-        sep="\t",
-        header=None,
-        usecols=[0, 1, 2],
-        names=["tf", "action", "target"],
-        converters={
-            "action": lambda x: (
-                1
-                if x == "upregulates-expression"
-                else -1 if x == "downregulates-expression" else None
-            )
-        },
-    ).dropna()
-    prior_network = prior_network.reset_index(drop=True)
+    # Gather the matrix columns of the mapped genes
+    matrix = expression.matrix[:, names.index.to_numpy()]
 
-    g_file_path = os.path.join(upload_dir, g_file)
-    gene_exp = pd.read_csv(g_file_path, sep="\t", index_col=0)
+    # Zeros are missing values; keep genes measured in at least 5% of the cells
+    measured = matrix.getnnz(axis=0) >= int(expression.shape[0] * 0.05)
+    genes = pd.Index(names[measured].to_numpy(), name="index")
+    return prior_network, matrix[:, measured].tocsr(), genes, expression.cells
 
-    # Mouse to human Mapping process
-    mouse_to_human = read_mouse_to_human_mapping_file()
 
-    # Replace index with human gene IDs, filter, clean, and explode
-    gene_exp = gene_exp.rename(
-        index=dict(zip(mouse_to_human["Mouse"], mouse_to_human["Human"]))
-    )
-    gene_exp = gene_exp[gene_exp.index.str.match(r"^\[.*\]$")]
-    gene_exp.index = gene_exp.index.str.strip("[]")
-    gene_exp = (
-        gene_exp.assign(index=gene_exp.index.str.split(","))
-        .explode("index")
-        .reset_index(drop=True)
-    )
-    gene_exp = gene_exp.set_index("index")
+def dense_values(matrix) -> np.ndarray:
+    # genes x cells values of a cells x genes sparse matrix, NaN where not measured
+    values = matrix.T.toarray().astype(np.float64)
+    values[values == 0] = np.nan
+    return values
 
-    gene_exp = gene_exp.replace(0.0, np.nan).dropna(
-        thresh=int(len(gene_exp.columns) * 0.05)
-    )
+
+def read_data(p_file: str, g_file: str, upload_dir, dataset: SessionDataset = None):
+    prior_network, matrix, genes, cells = read_sparse_data(p_file, g_file, upload_dir, dataset=dataset)
+    gene_exp = pd.DataFrame(dense_values(matrix), index=genes, columns=cells)
 
     return prior_network, gene_exp
 
 
-def get_pvalues(prior_file: str, gene_file: str, iters: int, upload_dir) -> pd.DataFrame:
-    try:
-        prior_net, gene_e = read_data(prior_file, gene_file, upload_dir)
-        p_values = main(prior_net, gene_e, iters)
+def get_pvalues(
+        prior_file: str,
+        gene_file: str,
+        iters: int,
+        upload_dir,
+        engine: str = "vectorized",
+        dataset: SessionDataset = None,
+) -> pd.DataFrame:
+    def compute():
+        with metrics.stage("tf_input") as stage:
+            prior_net, gene_e = read_data(prior_file, gene_file, upload_dir, dataset=dataset)
+            stage.set(*gene_e.shape)
+        p_values = main(prior_net, gene_e, iters, engine=engine)
         p_values.dropna(axis=1, how="all", inplace=True)
         return p_values
 
+    try:
+        if dataset is None:
+            return compute()
+
+        # Cached for the cells that passed quality control, the prior network,
+        # the ortholog index and the scoring parameters; the UMAP parameters
+        # play no part
+        key = stage_cache.stage_key(
+            "tf_scores",
+            dataset.qc_key,
+            prior=file_hash(os.path.join(upload_dir, prior_file)),
+            orthologs=get_ortholog_index().meta,
+            iters=iters,
+            engine=engine,
+        )
+        scores = stage_cache.cached("tf_scores", key, lambda: frame_arrays(compute()))
+        return pd.DataFrame(scores["values"], index=scores["rows"], columns=pd.Index(scores["columns"], name="tf"))
+
+    except Exception as e:
+        raise Exception(f"Failed to run the analysis: {e}")
+
+
+def frame_arrays(frame: pd.DataFrame) -> dict:
+    return dict(
+        values=frame.to_numpy(dtype=np.float64),
+        rows=frame.index.to_numpy(dtype=str),
+        columns=frame.columns.to_numpy(dtype=str),
+    )
+
+
+def stream_pvalues(
+        prior_file: str,
+        gene_file: str,
+        iters: int,
+        upload_dir,
+        dataset: SessionDataset = None,
+        chunk_cells: int = TF_STREAM_CHUNK_CELLS,
+):
+    # Streaming version of get_pvalues for the vectorized engine. The gene
+    # statistics come from the sparse matrix, then every chunk of cells is
+    # scored and written to an uncommitted float64 "raw_p_values" matrix of
+    # result_format.create_matrix. Returns (matrix, cells, TFs, positions of
+    # the TFs with any p-value); the caller corrects and discards the matrix
+    try:
+        with metrics.stage("tf_input") as stage:
+            prior_network, matrix, genes, cells = read_sparse_data(prior_file, gene_file, upload_dir, dataset)
+            stage.set(len(genes), len(cells))
+        with metrics.stage("sd_table", prior_network.max_target, len(genes)):
+            distribution = get_sd(
+                max_target=prior_network.max_target,
+                total_genes=len(genes),
+                iters=iters,
+            )
+        incidence = build_incidence(prior_network, genes)
+        groups = duplicate_groups(genes)
+        stats = sparse_gene_stats(matrix)
+    except Exception as e:
+        raise Exception(f"Failed to run the analysis: {e}")
+
+    tfs = prior_network.tfs
+    output = create_matrix(upload_dir, "raw_p_values", (len(cells), len(tfs)), np.float64)
+    has_value = np.zeros(len(tfs), dtype=bool)
+    try:
+        with metrics.stage("scoring", len(cells), len(tfs)):
+            for begin in range(0, len(cells), chunk_cells):
+                end = min(begin + chunk_cells, len(cells))
+                p_vals = score_cells(dense_values(matrix[begin:end]), incidence, distribution, groups, stats=stats)
+                output[begin:end] = p_vals
+                has_value |= ~np.isnan(p_vals).all(axis=0)
+                print(f"Scored {end} of {len(cells)} cells")
     except Exception as e:
+        discard_matrix(output)
         raise Exception(f"Failed to run the analysis: {e}")
 
+    return output, cells, tfs, np.flatnonzero(has_value)
@@ -1,7 +1,46 @@
+import json
 import scanpy as sc
 import pandas as pd
 import os
-from pathlib import Path
+from scipy import sparse
+
+from app.utils import metrics, result_format, stage_cache, threads
+from app.utils.dataset import SessionDataset
+from app.utils.neighbors import NEIGHBORS_BACKEND, neighbors_transformer
+
+
+def graph_arrays(name, matrix) -> dict:
+    matrix = sparse.csr_matrix(matrix)
+    return {
+        f"{name}_data": matrix.data,
+        f"{name}_indices": matrix.indices,
+        f"{name}_indptr": matrix.indptr,
+        f"{name}_shape": matrix.shape,
+    }
+
+
+def graph_matrix(name, arrays):
+    return sparse.csr_matrix(
+        (arrays[f"{name}_data"], arrays[f"{name}_indices"], arrays[f"{name}_indptr"]),
+        shape=tuple(arrays[f"{name}_shape"]),
+    )
+
+
+def run_umap(pcs, distances, connectivities, neighbors_params: dict, min_dist: float):
+    # UMAP embedding of a neighbors graph; needs only the PCs, not the expression
+    import anndata
+
+    adata = anndata.AnnData(obs=pd.DataFrame(index=pd.RangeIndex(len(pcs)).astype(str)))
+    adata.obsm["X_pca"] = pcs
+    adata.obsp["distances"] = distances
+    adata.obsp["connectivities"] = connectivities
+    adata.uns["neighbors"] = {
+        "connectivities_key": "connectivities",
+        "distances_key": "distances",
+        "params": dict(neighbors_params),
+    }
+    sc.tl.umap(adata, min_dist=min_dist)
+    return adata.obsm["X_umap"]
 
 
 def run_umap_pipeline(
@@ -22,70 +61,120 @@ def run_umap_pipeline(
         min_dist: float = 0.1,
         metric: str = "cosine",
         uuid_folder_name: str = None,
+        dataset: SessionDataset = None,
+        neighbors_backend: str = NEIGHBORS_BACKEND,
 ) -> pd.DataFrame:
-    # Path to the "uploads" folder (use absolute path for robustness)
-    upload_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads/" + uuid_folder_name)
-
-    data_matrix_path = os.path.join(upload_dir, data_matrix_filename)
-    meta_data_path = os.path.join(upload_dir, meta_data_filename)
-
-    if not Path(data_matrix_path).exists():
-        raise FileNotFoundError(f"File not found: {data_matrix_path}")
-    if not Path(meta_data_path).exists():
-        raise FileNotFoundError(f"File not found: {meta_data_path}")
-
-    # Use pandas to read the data for better performance
-    data_matrix = pd.read_csv(data_matrix_path, delimiter="\t", index_col=0).T
-    meta_data = pd.read_csv(meta_data_path, sep="\t", index_col=0)
-
-    meta_data.index = meta_data.index.str.replace(r"[ -]", ".", regex=True)
-
-    # Match index of data_matrix and meta_data
-    common_indices = data_matrix.index.intersection(meta_data.index)
-    data_matrix = data_matrix.loc[common_indices]
-    meta_data = meta_data.loc[common_indices]
-
-    adata = sc.AnnData(data_matrix)
-    adata.obs = meta_data
-
-    # Filter cells and genes
-    print("Filtering and normalizing data...")
-    if filter_cells == "on":
-        sc.pp.filter_cells(adata, min_genes=filter_genes_value)
-    if filter_genes == "on":
-        sc.pp.filter_genes(adata, min_cells=filter_cells_value)
-
-    # Filter mitochondrial genes
-    print("Filtering mitochondrial genes...")
-    if qc_filter == "on":
-        adata.var["mt"] = adata.var_names.str.startswith("MT-")
-        sc.pp.calculate_qc_metrics(
-            adata, qc_vars=["mt"], percent_top=None, log1p=False, inplace=True
+    if dataset is None:
+        # Path to the "uploads" folder (use absolute path for robustness)
+        upload_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads/" + uuid_folder_name)
+        dataset = SessionDataset(upload_dir, data_matrix_filename, meta_data_filename)
+
+    # Quality control also decides the cells the TF analysis runs on
+    with metrics.stage("qc") as stage:
+        adata = dataset.apply_qc(
+            filter_cells=filter_cells,
+            filter_cells_value=filter_cells_value,
+            filter_genes=filter_genes,
+            filter_genes_value=filter_genes_value,
+            qc_filter=qc_filter,
+            qc_filter_value=qc_filter_value,
         )
-        adata = adata[adata.obs.pct_counts_mt < qc_filter_value, :]
-        del adata.var["mt"]
+        stage.set(*adata.shape)
+
+    # Every step below is cached under the hash of its parameters and those of
+    # the steps before it, so only the steps after a changed parameter run
+    pca_key = stage_cache.stage_key(
+        "pca",
+        dataset.qc_key,
+        data_normalize=data_normalize,
+        data_normalize_value=data_normalize_value,
+        log_transform=log_transform,
+        pca_components=pca_components,
+    )
+    neighbors_key = stage_cache.stage_key(
+        "neighbors", pca_key, n_neighbors=n_neighbors, metric=metric, backend=neighbors_backend
+    )
+    umap_key = stage_cache.stage_key("umap", neighbors_key, min_dist=min_dist)
 
-    # Normalize data
-    print("Normalizing data...")
-    if data_normalize == "on":
-        sc.pp.normalize_total(adata, target_sum=data_normalize_value)
+    def normalize_and_pca():
+        with metrics.stage("normalize", *adata.shape):
+            # Normalize data
+            print("Normalizing data...")
+            if data_normalize == "on":
+                sc.pp.normalize_total(adata, target_sum=data_normalize_value)
 
-    # Log transformation
-    print("Log transforming data...")
-    if log_transform == "on":
-        sc.pp.log1p(adata)
+            # Log transformation
+            print("Log transforming data...")
+            if log_transform == "on":
+                sc.pp.log1p(adata)
 
-    # sc.pp.highly_variable_genes(adata, n_top_genes=2000, subset=True)
-    # sc.pp.scale(adata, max_value=10)
+        # sc.pp.highly_variable_genes(adata, n_top_genes=2000, subset=True)
+        # sc.pp.scale(adata, max_value=10)
 
-    # Perform PCA
-    print("Running PCA...")
-    sc.tl.pca(adata, n_comps=pca_components)
+        # Perform PCA
+        print("Running PCA...")
+        with metrics.stage("pca", *adata.shape):
+            sc.tl.pca(adata, n_comps=pca_components)
+        return dict(X_pca=adata.obsm["X_pca"])
+
+    # BLAS, OpenMP and numba threads of this branch stay within its budget
+    with threads.limit_threads(threads.UMAP_THREADS):
+        adata.obsm["X_pca"] = stage_cache.cached("pca", pca_key, normalize_and_pca)["X_pca"]
 
     # Perform UMAP
     print("Running UMAP...")
-    sc.pp.neighbors(adata, n_neighbors=n_neighbors, n_pcs=pca_components, metric=metric)
-    sc.tl.umap(adata, min_dist=min_dist)
+
+    def neighbors():
+        with metrics.stage("neighbors", adata.n_obs, pca_components):
+            sc.pp.neighbors(
+                adata,
+                n_neighbors=n_neighbors,
+                n_pcs=pca_components,
+                metric=metric,
+                transformer=neighbors_transformer(neighbors_backend, n_neighbors, metric, threads.UMAP_THREADS),
+            )
+        return dict(
+            params=json.dumps(adata.uns["neighbors"]["params"]),
+            **graph_arrays("distances", adata.obsp["distances"]),
+            **graph_arrays("connectivities", adata.obsp["connectivities"]),
+        )
+
+    with threads.limit_threads(threads.UMAP_THREADS):
+        graph = stage_cache.cached("neighbors", neighbors_key, neighbors)
+    if "neighbors" not in adata.uns:
+        adata.obsp["distances"] = graph_matrix("distances", graph)
+        adata.obsp["connectivities"] = graph_matrix("connectivities", graph)
+        adata.uns["neighbors"] = {
+            "connectivities_key": "connectivities",
+            "distances_key": "distances",
+            "params": json.loads(str(graph["params"])),
+        }
+
+    def umap():
+        with metrics.stage("umap", adata.n_obs, 2):
+            embedding = run_umap(
+                adata.obsm["X_pca"],
+                adata.obsp["distances"],
+                adata.obsp["connectivities"],
+                adata.uns["neighbors"]["params"],
+                min_dist,
+            )
+        return dict(X_umap=embedding)
+
+    with threads.limit_threads(threads.UMAP_THREADS):
+        adata.obsm["X_umap"] = stage_cache.cached("umap", umap_key, umap)["X_umap"]
+
+    # Kept with the session so the embedding can be recomputed on its own
+    with metrics.stage("write_graph", adata.n_obs, pca_components):
+        result_format.write_graph(
+            dataset.upload_dir,
+            adata.obs_names,
+            adata.obsm["X_pca"],
+            adata.obsp["distances"],
+            adata.obsp["connectivities"],
+            adata.uns["neighbors"]["params"],
+            neighbors_key,
+        )
 
     print("Saving UMAP coordinates...")
     # cluster_column = "seurat_clusters"
@@ -0,0 +1,201 @@
+import os
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.special import erf
+from scipy.stats import rankdata
+
+# Vectorized rank-sum scoring. The compiled prior network is turned once into
+# sparse TF x gene incidence matrices and every cell of a block is scored with
+# a handful of sparse-dense matrix products instead of a per-TF Python loop.
+
+MIN_TARGETS = 3
+
+# Cells z-scored, ranked and scored together by score_expression; small tiles
+# keep the working set of a tile in cache
+TF_TILE_SIZE = int(os.getenv("TF_TILE_SIZE", "64"))
+
+# Activating and inhibiting rank-sums closer than this many machine epsilons
+# of the rank dtype per target are a tie that only differs by rounding
+TIE_TOLERANCE = 8
+
+
+class Incidence(NamedTuple):
+    tfs: pd.Index
+    genes: pd.Index  # Unique gene vocabulary, in order of first appearance
+    n_edges: np.ndarray  # Total number of edges of each TF in the prior network
+    positive: sparse.csr_matrix  # TF x gene counts of upregulating edges
+    negative: sparse.csr_matrix  # TF x gene counts of downregulating edges
+
+
+def build_incidence(prior_network, genes: pd.Index) -> Incidence:
+    # prior_network is a compiled PriorNetwork; its target vocabulary is aligned
+    # to the expression genes once and the CSR edges are reused as they are
+    genes = pd.Index(pd.unique(np.asarray(genes)))
+    gene_codes = genes.get_indexer(prior_network.genes)[prior_network.targets]
+    tf_codes = prior_network.edge_tfs()
+    up = prior_network.signs == 1
+
+    # Targets which are not measured in the expression data never become valid
+    found = gene_codes >= 0
+    shape = (len(prior_network.tfs), len(genes))
+
+    def _counts(mask):
+        mask = mask & found
+        return sparse.csr_matrix(
+            (np.ones(mask.sum()), (tf_codes[mask], gene_codes[mask])), shape=shape
+        )
+
+    return Incidence(
+        tfs=prior_network.tfs,
+        genes=genes,
+        n_edges=prior_network.n_edges,
+        positive=_counts(up),
+        negative=_counts(~up),
+    )
+
+
+def rank_cells(values: np.ndarray, dtype=np.float32):
+    # values is cells x genes and NaN where the gene is not measured. All cells
+    # are ranked in one pass; ranks are normalized to (0, 1) per cell and the
+    # highest expressed gene gets the lowest rank
+    ranks = rankdata(-values, axis=1, nan_policy="omit")
+    measured = np.sum(~np.isnan(values), axis=1, keepdims=True)
+    rank = np.ascontiguousarray((ranks - 0.5) / measured, dtype=dtype)
+    rev_rank = 1 - rank
+    return rank, rev_rank
+
+
+def duplicate_groups(genes: pd.Index):
+    # A human gene can appear on several rows after the orthology mapping; the
+    # rank of a target is then the average rank of its measured rows. Returns
+    # a rows x unique genes indicator matrix, or None when genes are unique
+    codes, unique_genes = pd.factorize(np.asarray(genes))
+    if len(unique_genes) == len(genes):
+        return None
+    return sparse.csr_matrix(
+        (np.ones(len(codes)), (np.arange(len(codes)), codes)),
+        shape=(len(codes), len(unique_genes)),
+    )
+
+
+def collapse_duplicates(values: np.ndarray, groups) -> np.ndarray:
+    if groups is None:
+        return values
+    present = ~np.isnan(values)
+    totals = groups.T.dot(np.where(present, values, 0).T).T
+    counts = groups.T.dot(present.T.astype(np.float64)).T
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return totals / counts
+
+
+def rank_sums(rank: np.ndarray, rev_rank: np.ndarray, incidence: Incidence, groups=None):
+    # rank and rev_rank are cells x gene rows as returned by rank_cells. Returns
+    # the signed average rank-sums, the valid target counts and the mask of
+    # cells x TFs without enough valid targets
+    tie_tolerance = TIE_TOLERANCE * np.finfo(rank.dtype).eps
+    rank = collapse_duplicates(np.asarray(rank, dtype=np.float64), groups)
+    rev_rank = collapse_duplicates(np.asarray(rev_rank, dtype=np.float64), groups)
+
+    present = ~np.isnan(rank)
+    rank = np.where(present, rank, 0.0).T
+    rev_rank = np.where(present, rev_rank, 0.0).T
+    present = present.T.astype(np.float64)
+
+    # acti_rs adds rank for upregulated and rev_rank for downregulated targets,
+    # inhi_rs is the mirror image
+    acti_rs = (incidence.positive.dot(rank) + incidence.negative.dot(rev_rank)).T
+    inhi_rs = (incidence.positive.dot(rev_rank) + incidence.negative.dot(rank)).T
+    valid_targets = ((incidence.positive + incidence.negative).dot(present)).T
+
+    invalid = (valid_targets < MIN_TARGETS) | (incidence.n_edges < MIN_TARGETS)[np.newaxis, :]
+    valid_targets = np.where(invalid, 1, valid_targets)
+
+    rs = np.minimum(acti_rs, inhi_rs) / valid_targets  # Average rank-sum
+    rs = np.where(acti_rs < inhi_rs - tie_tolerance * valid_targets, rs, -rs)
+    return rs, valid_targets, invalid
+
+
+def rank_sum_p_values(rs: np.ndarray, valid_targets: np.ndarray, invalid: np.ndarray, distribution: np.ndarray):
+    z_vals = (np.abs(rs) - 0.5) / distribution[valid_targets.astype(int) - 1]
+    p_vals = 1 + erf(z_vals / np.sqrt(2))
+
+    # Adjust sign based on 'rs' values
+    p_vals = np.where(rs > 0, p_vals, -p_vals)
+    p_vals[invalid] = np.nan
+    return p_vals
+
+
+def score_ranks(
+        rank: np.ndarray,
+        rev_rank: np.ndarray,
+        incidence: Incidence,
+        distribution: np.ndarray,
+        groups=None,
+) -> np.ndarray:
+    # rank and rev_rank are cells x gene rows as returned by rank_cells; returns
+    # a cells x TFs array of signed p-values
+    rs, valid_targets, invalid = rank_sums(rank, rev_rank, incidence, groups)
+    return rank_sum_p_values(rs, valid_targets, invalid, distribution)
+
+
+def _measured_stats(measured: np.ndarray):
+    # Mean and population SD of the measured values of one gene, computed as
+    # scipy.stats.zscore(nan_policy="omit") does so that z-scores and their
+    # ties match it exactly; a constant gene gets a NaN SD and NaN z-scores
+    if measured.size == 0:
+        return np.nan, np.nan
+    if (measured == measured[0]).all():
+        return np.mean(measured), np.nan
+    return np.mean(measured), np.std(measured)
+
+
+def gene_stats(values: np.ndarray):
+    # values is genes x cells and NaN where the gene is not measured. Returns the
+    # mean and population SD of every gene over its measured cells
+    stats = [_measured_stats(row[~np.isnan(row)]) for row in values]
+    return np.array([mean for mean, _ in stats]), np.array([std for _, std in stats])
+
+
+def sparse_gene_stats(matrix: sparse.spmatrix):
+    # gene_stats of a cells x genes sparse matrix whose stored nonzeros are the
+    # measured values, without densifying it. Values are summed in cell order
+    matrix = sparse.csc_matrix(matrix, dtype=np.float64)
+    matrix.eliminate_zeros()
+    matrix.sort_indices()
+    stats = []
+    for begin, end in zip(matrix.indptr[:-1], matrix.indptr[1:]):
+        measured = matrix.data[begin:end]
+        stats.append(_measured_stats(measured[~np.isnan(measured)]))
+    return np.array([mean for mean, _ in stats]), np.array([std for _, std in stats])
+
+
+def zscore_tile(values: np.ndarray, mean: np.ndarray, std: np.ndarray) -> np.ndarray:
+    # values is a genes x cells tile; returns the z-scores as cells x genes
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (values.T - mean) / std
+
+
+def score_expression(
+        values: np.ndarray,
+        mean: np.ndarray,
+        std: np.ndarray,
+        incidence: Incidence,
+        distribution: np.ndarray,
+        groups=None,
+        start: int = 0,
+        stop: int = None,
+        tile_size: int = TF_TILE_SIZE,
+) -> np.ndarray:
+    # Fused scoring of the cells start:stop of the genes x cells expression
+    # values: every tile of cells is z-scored, ranked and scored before the
+    # next one is touched. Returns a cells x TFs array of signed p-values
+    stop = values.shape[1] if stop is None else min(stop, values.shape[1])
+    p_vals = np.empty((stop - start, len(incidence.n_edges)))
+    for begin in range(start, stop, tile_size):
+        end = min(begin + tile_size, stop)
+        rank, rev_rank = rank_cells(zscore_tile(values[:, begin:end], mean, std))
+        p_vals[begin - start:end - start] = score_ranks(rank, rev_rank, incidence, distribution, groups)
+    return p_vals
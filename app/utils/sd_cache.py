@@ -0,0 +1,212 @@
+import argparse
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+from app.utils import metrics
+
+# Cache of the SD distribution tables used by the TF analysis.
+#
+# Tables are content addressed: a family hash of (kind, total_genes, iters) plus
+# max_target names the file, so a table generated for a larger max_target is
+# reused (sliced) for every smaller one. Files are written atomically, one
+# process generates a family at a time under a file lock, the directory is
+# kept below SD_CACHE_MAX_BYTES by evicting the least recently used tables and
+# loaded tables are memoized in the process.
+#
+#   python -m app.utils.sd_cache warm 500:10000 1000:20000 --iters 1000
+
+CACHE_VERSION = 1
+
+SD_CACHE_DIR = os.getenv(
+    "SD_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads", "sd_cache"),
+)
+SD_CACHE_MAX_BYTES = int(os.getenv("SD_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+SD_CACHE_MEMORY_ENTRIES = 64
+
+_memory = OrderedDict()
+_memory_lock = threading.Lock()
+
+
+def family_key(kind: str, total_genes: int, iters: int) -> str:
+    params = {
+        "kind": kind,
+        "total_genes": int(total_genes),
+        "iters": int(iters),
+        "version": CACHE_VERSION,
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def _table_path(family: str, max_target: int) -> str:
+    return os.path.join(SD_CACHE_DIR, f"{family}_{max_target}.npz")
+
+
+def _remember(family: str, table: np.ndarray):
+    with _memory_lock:
+        cached = _memory.get(family)
+        if cached is None or len(cached) < len(table):
+            _memory[family] = table
+        _memory.move_to_end(family)
+        while len(_memory) > SD_CACHE_MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+
+
+def _from_memory(family: str, max_target: int):
+    with _memory_lock:
+        table = _memory.get(family)
+        if table is None or len(table) < max_target:
+            return None
+        _memory.move_to_end(family)
+        return table[:max_target]
+
+
+def _from_disk(family: str, max_target: int):
+    # Smallest stored table covering max_target
+    candidates = []
+    for path in glob.glob(os.path.join(SD_CACHE_DIR, f"{family}_*.npz")):
+        stored = int(os.path.basename(path)[len(family) + 1:-len(".npz")])
+        if stored >= max_target:
+            candidates.append((stored, path))
+
+    for stored, path in sorted(candidates):
+        try:
+            with np.load(path) as stored_tables:
+                table = stored_tables["distribution"]
+        except (OSError, ValueError, KeyError):
+            continue  # Evicted or damaged in the meantime
+        try:
+            os.utime(path)  # Mark as recently used for the LRU eviction
+        except FileNotFoundError:
+            pass
+        _remember(family, table)
+        return table[:max_target]
+    return None
+
+
+@contextmanager
+def _locked(family: str):
+    with open(os.path.join(SD_CACHE_DIR, f"{family}.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _atomic_save(path: str, table: np.ndarray):
+    fd, tmp_path = tempfile.mkstemp(dir=SD_CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(f, distribution=table)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def evict(max_bytes: int = None):
+    # Remove least recently used tables until the cache fits into max_bytes
+    max_bytes = SD_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    tables = []
+    for path in glob.glob(os.path.join(SD_CACHE_DIR, "*.npz")):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        tables.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in tables)
+    for _, size, path in sorted(tables):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            print(f"Evicted SD distribution file: {path}")
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def get_distribution(kind: str, max_target: int, total_genes: int, iters: int, generate) -> np.ndarray:
+    # generate(max_target, total_genes, iters) builds the table on a cache miss
+    family = family_key(kind, total_genes, iters)
+
+    table = _from_memory(family, max_target)
+    if table is not None:
+        metrics.cache_event("sd_table", True, tier="memory")
+        return table
+
+    os.makedirs(SD_CACHE_DIR, exist_ok=True)
+    table = _from_disk(family, max_target)
+    if table is not None:
+        print("Distribution file exists. Now we have to read it.")
+        metrics.cache_event("sd_table", True, tier="disk")
+        return table
+
+    with _locked(family):
+        # Another process may have generated it while we waited for the lock
+        table = _from_disk(family, max_target)
+        if table is not None:
+            print("Distribution file exists. Now we have to read it.")
+            metrics.cache_event("sd_table", True, tier="disk")
+            return table
+
+        print("Distribution file does not exist. Now we have to generate it.")
+        metrics.cache_event("sd_table", False)
+        table = np.asarray(generate(max_target, total_genes, iters))
+        _atomic_save(_table_path(family, max_target), table)
+
+    _remember(family, table)
+    evict()
+    return table
+
+
+def clear_memory():
+    with _memory_lock:
+        _memory.clear()
+
+
+def warm(pairs, iters: int):
+    from app.utils.run_analysis import simulate_distribution
+
+    for max_target, total_genes in pairs:
+        print(f"Warming SD distribution max_target={max_target} total_genes={total_genes} iters={iters}")
+        get_distribution("min_folded", max_target, total_genes, iters, simulate_distribution)
+
+
+def _pair(value: str):
+    max_target, total_genes = value.split(":")
+    return int(max_target), int(total_genes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the SD distribution cache")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    warm_parser = commands.add_parser("warm", help="Pre-generate distribution tables")
+    warm_parser.add_argument("pairs", nargs="+", type=_pair, help="max_target:total_genes")
+    warm_parser.add_argument("--iters", type=int, default=1000)
+
+    evict_parser = commands.add_parser("evict", help="Shrink the cache to a byte budget")
+    evict_parser.add_argument("--max-bytes", type=int, default=SD_CACHE_MAX_BYTES)
+
+    args = parser.parse_args()
+    if args.command == "warm":
+        warm(args.pairs, args.iters)
+    elif args.command == "evict":
+        evict(args.max_bytes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+from app.utils import metrics
+
+# Content addressed cache of pipeline stage outputs. A job is a DAG of stages
+#
+#   parse -> qc -> pca (normalize, log, PCA) -> neighbors -> umap
+#   parse -> qc -> tf_scores (orthologs, z-score, scoring) -> bh
+#
+# The key of parse is the hash of the uploaded matrix files; every other key
+# is the hash of its parent key and the stage parameters. An output is a dict
+# of arrays stored as one .npz file named by its key, so a job re-submitted
+# with only min_dist changed loads the neighbors graph and reruns the
+# embedding, and one with only iters changed reruns the scoring alone.
+# Like the SD cache, files are written atomically, one process computes a key
+# at a time under a file lock and the directory is kept below
+# STAGE_CACHE_MAX_BYTES by evicting the least recently used outputs.
+
+STAGE_VERSION = 3
+
+STAGE_CACHE_DIR = os.getenv(
+    "STAGE_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads", "stage_cache"),
+)
+STAGE_CACHE_MAX_BYTES = int(os.getenv("STAGE_CACHE_MAX_BYTES", str(4 * 1024 ** 3)))
+STAGE_CACHE_MEMORY_BYTES = int(os.getenv("STAGE_CACHE_MEMORY_BYTES", str(256 * 1024 ** 2)))
+
+# Keys share a fixed set of lock files, so jobs computing different outputs
+# rarely wait for each other and no lock file is left behind per key
+STAGE_LOCK_STRIPES = 16
+
+_memory = OrderedDict()
+_memory_lock = threading.Lock()
+
+
+def file_key(*paths) -> str:
+    digest = hashlib.sha256(f"input-v{STAGE_VERSION}".encode())
+    for path in paths:
+        digest.update(b"\0")
+        if path is None:
+            continue
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+    return digest.hexdigest()[:32]
+
+
+def names_key(names) -> str:
+    digest = hashlib.sha256()
+    for name in names:
+        digest.update(str(name).encode() + b"\0")
+    return digest.hexdigest()[:32]
+
+
+def stage_key(stage: str, parent: str, **params) -> str:
+    params = {"stage": stage, "parent": parent, "params": params, "version": STAGE_VERSION}
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+
+def _path(stage: str, key: str) -> str:
+    return os.path.join(STAGE_CACHE_DIR, f"{stage}_{key}.npz")
+
+
+def _nbytes(arrays: dict) -> int:
+    return sum(np.asarray(values).nbytes for values in arrays.values())
+
+
+def _remember(key: str, arrays: dict):
+    with _memory_lock:
+        _memory[key] = arrays
+        _memory.move_to_end(key)
+        total = sum(_nbytes(entry) for entry in _memory.values())
+        while total > STAGE_CACHE_MEMORY_BYTES and _memory:
+            _, evicted = _memory.popitem(last=False)
+            total -= _nbytes(evicted)
+
+
+def _from_memory(key: str):
+    with _memory_lock:
+        arrays = _memory.get(key)
+        if arrays is not None:
+            _memory.move_to_end(key)
+        return arrays
+
+
+def _from_disk(stage: str, key: str):
+    path = _path(stage, key)
+    try:
+        with np.load(path, allow_pickle=False) as stored:
+            arrays = {name: stored[name] for name in stored.files}
+    except (OSError, ValueError, KeyError):
+        return None  # Not computed, evicted or damaged
+    try:
+        os.utime(path)  # Mark as recently used for the LRU eviction
+    except FileNotFoundError:
+        pass
+    return arrays
+
+
+@contextmanager
+def _locked(key: str):
+    stripe = int(key, 16) % STAGE_LOCK_STRIPES
+    with open(os.path.join(STAGE_CACHE_DIR, f"stripe_{stripe}.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _atomic_save(path: str, arrays: dict):
+    fd, tmp_path = tempfile.mkstemp(dir=STAGE_CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def evict(max_bytes: int = None):
+    # Remove least recently used outputs until the cache fits into max_bytes
+    max_bytes = STAGE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    outputs = []
+    for path in glob.glob(os.path.join(STAGE_CACHE_DIR, "*.npz")):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        outputs.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in outputs)
+    for _, size, path in sorted(outputs):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            print(f"Evicted stage output: {path}")
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def cached(stage: str, key: str, compute) -> dict:
+    # Output of the stage under key; compute() returns the dict of arrays on a miss
+    arrays = _from_memory(key)
+    if arrays is not None:
+        metrics.cache_event("stage_output", True, stage=stage, tier="memory")
+        return arrays
+
+    os.makedirs(STAGE_CACHE_DIR, exist_ok=True)
+    arrays = _from_disk(stage, key)
+    if arrays is None:
+        with _locked(key):
+            # Another job may have computed it while we waited for the lock
+            arrays = _from_disk(stage, key)
+            if arrays is None:
+                print(f"Stage {stage} is not cached. Now we have to compute it.")
+                metrics.cache_event("stage_output", False, stage=stage)
+                arrays = {name: np.asarray(values) for name, values in compute().items()}
+                _atomic_save(_path(stage, key), arrays)
+                _remember(key, arrays)
+                evict()
+                return arrays
+
+    print(f"Stage {stage} is cached. Now we have to read it.")
+    metrics.cache_event("stage_output", True, stage=stage, tier="disk")
+    _remember(key, arrays)
+    return arrays
+
+
+def clear_memory():
+    with _memory_lock:
+        _memory.clear()
@@ -2,10 +2,12 @@ import os
 import pandas as pd
 import numpy as np
 from scipy.stats import zscore
-import requests
 from scipy.special import erf
 from joblib import Parallel, delayed
 
+from app.utils import sd_cache
+from app.utils.dataset import map_human_genes
+
 # This analysis using single n and all k's
 
 # Path to the "uploads" folder (use absolute path for robustness)
@@ -18,16 +20,27 @@ def distribution_worker(max_target: int, ranks: np.array):
     return arr
 
 
-def get_sd(max_target: int, total_genes: int, iters: int):
-    sd_file = f"SD_anal_{max_target}_{total_genes}_{iters}.npz"
-    sd_file = os.path.join(UPLOAD_DIR, sd_file)
+def analytic_sd(max_target: int, total_genes: int):
+    # SD of the mean of k ranks drawn without replacement from the (i - 0.5) / n
+    # rank grid: the grid variance (n^2 - 1) / (12 n^2) divided by k, with the
+    # finite population correction (n - k) / (n - 1)
+    n = total_genes
+    k = np.arange(1, max_target + 1)
+    if n <= 1:
+        return np.zeros(max_target)
+    var = (n ** 2 - 1) / (12 * n ** 2) / k * (n - k) / (n - 1)
+    return np.sqrt(np.clip(var, 0, None))
+
 
-    if os.path.isfile(sd_file):
-        print("Distribution file exists. Now we have to read it.")
-        return np.load(sd_file)["distribution"]
+def get_sd(max_target: int, total_genes: int, iters: int, method: str = "analytic"):
+    if method == "analytic":
+        return analytic_sd(max_target, total_genes)
+    if method != "simulation":
+        raise ValueError(f"Unknown SD method: {method}")
+    return sd_cache.get_distribution("mean", max_target, total_genes, iters, simulate_sd)
 
-    print("Distribution file does not exist. Now we have to generate it.")
 
+def simulate_sd(max_target: int, total_genes: int, iters: int):
     # n = total_genes  # Sampling size for random distribution
     ranks = np.linspace(start=1, stop=total_genes, num=total_genes)
     ranks = (ranks - 0.5) / total_genes
@@ -35,9 +48,7 @@ def get_sd(max_target: int, total_genes: int, iters: int):
     dist = Parallel(n_jobs=-1, verbose=5, backend="multiprocessing")(
         delayed(distribution_worker)(max_target, ranks) for _ in range(iters)
     )
-    sd_dist = np.std(np.array(dist).T, axis=1)
-    np.savez_compressed(file=sd_file, distribution=sd_dist)
-    return sd_dist
+    return np.std(np.array(dist).T, axis=1)
 
 
 def sample_worker(
@@ -137,30 +148,6 @@ def main(prior_network: pd.DataFrame, gene_exp: pd.DataFrame, iters: int):
     )
 
 
-def read_mouse_to_human_mapping_file():
-    mth_file = "mouse_to_human.tsv"
-    mth_file_path = os.path.join(UPLOAD_DIR, mth_file)
-
-    if os.path.isfile(mth_file_path):
-        print("Mouse to human mapping file exists. Let's read")
-        return pd.read_csv(mth_file_path, sep="\t")
-
-    print("Mouse to human mapping file does not exist. Let's download it.\n")
-    file_url = "https://www.cs.umb.edu/~kisan/data/mouse_to_human.tsv"
-
-    try:
-        response = requests.get(file_url)
-        with open(mth_file_path, "wb") as f:
-            f.write(response.content)
-        print("Mouse to human mapping file downloaded successfully.")
-
-    except requests.exceptions.RequestException as e:
-        print(f"Failed to download the mouse to human map file: {e}")
-        raise Exception(f"Failed to download the mouse to human map file: {e}")
-
-    return pd.read_csv(mth_file_path, sep="\t")
-
-
 def read_data(p_file: str, g_file: str, upload_dir):
     p_file_path = os.path.join(upload_dir, p_file)
 
@@ -183,21 +170,11 @@ def read_data(p_file: str, g_file: str, upload_dir):
     g_file_path = os.path.join(upload_dir, g_file)
     gene_exp = pd.read_csv(g_file_path, sep="\t", index_col=0)
 
-    # Mouse to human Mapping process
-    mouse_to_human = read_mouse_to_human_mapping_file()
-
-    # Replace index with human gene IDs, filter, clean, and explode
-    gene_exp = gene_exp.rename(
-        index=dict(zip(mouse_to_human["Mouse"], mouse_to_human["Human"]))
-    )
-    gene_exp = gene_exp[gene_exp.index.str.match(r"^\[.*\]$")]
-    gene_exp.index = gene_exp.index.str.strip("[]")
-    gene_exp = (
-        gene_exp.assign(index=gene_exp.index.str.split(","))
-        .explode("index")
-        .reset_index(drop=True)
-    )
-    gene_exp = gene_exp.set_index("index")
+    # Mouse to human Mapping process: gather the rows of the mapped genes, once
+    # per human gene ID
+    names = map_human_genes(gene_exp.index)
+    gene_exp = gene_exp.iloc[names.index.to_numpy()]
+    gene_exp.index = pd.Index(names.to_numpy(), name="index")
 
     gene_exp = gene_exp.replace(0.0, np.nan).dropna(
         thresh=int(len(gene_exp.columns) * 0.05)
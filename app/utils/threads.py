@@ -0,0 +1,70 @@
+import os
+import threading
+from contextlib import contextmanager
+
+# Thread budgets of the pipeline stages. A job runs the UMAP branch and the
+# TF branch side by side: the UMAP branch (normalization, PCA, neighbor
+# search, embedding) runs its BLAS, OpenMP and numba pools with at most
+# UMAP_THREADS threads, and the TF scoring runs TF_WORKERS worker processes
+# (see worker_pool) with TF_BLAS_THREADS BLAS threads each.
+# By default both branches may use every core, so a branch running alone is
+# not slowed down, at the price of oversubscribing the CPUs while both run.
+# Setting CPU_BUDGET splits that many cores in half between the branches
+# instead; this avoids the contention on a shared host but halves the
+# persistent TF worker pool for every job (compare benchmarks.suite
+# --cpu-budget against benchmarks/baseline.json).
+
+CPU_COUNT = os.cpu_count() or 1
+CPU_BUDGET = int(os.getenv("CPU_BUDGET", "0"))
+
+if CPU_BUDGET:
+    UMAP_THREADS = int(os.getenv("UMAP_THREADS", "0")) or max(1, CPU_BUDGET // 2)
+    TF_WORKERS = int(os.getenv("TF_WORKERS", "0")) or max(1, CPU_BUDGET - UMAP_THREADS)
+else:
+    UMAP_THREADS = int(os.getenv("UMAP_THREADS", "0")) or CPU_COUNT
+    TF_WORKERS = int(os.getenv("TF_WORKERS", "0")) or CPU_COUNT
+TF_BLAS_THREADS = int(os.getenv("TF_BLAS_THREADS", "1"))
+
+
+_blas_lock = threading.Lock()
+_blas_users = 0
+_blas_limiter = None
+_previous_jobs = None
+
+
+@contextmanager
+def limit_threads(threads: int):
+    # BLAS and OpenMP pools and scanpy's n_jobs are process wide: the first of
+    # concurrent callers limits them and the last one restores them. numba
+    # threads are set for the calling thread's work
+    global _blas_users, _blas_limiter, _previous_jobs
+    import numba
+    import scanpy as sc
+    from threadpoolctl import threadpool_limits
+
+    threads = max(1, int(threads))
+    previous_numba = numba.get_num_threads()
+    numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+    with _blas_lock:
+        if _blas_users == 0:
+            _blas_limiter = threadpool_limits(limits=threads)
+            _previous_jobs = sc.settings.n_jobs
+            sc.settings.n_jobs = threads
+        _blas_users += 1
+    try:
+        yield
+    finally:
+        with _blas_lock:
+            _blas_users -= 1
+            if _blas_users == 0:
+                _blas_limiter.restore_original_limits()
+                _blas_limiter = None
+                sc.settings.n_jobs = _previous_jobs
+        numba.set_num_threads(previous_numba)
+
+
+def limit_blas_threads(threads: int = TF_BLAS_THREADS):
+    # Process wide BLAS / OpenMP limit, for worker processes
+    from threadpoolctl import threadpool_limits
+
+    threadpool_limits(limits=max(1, int(threads)))
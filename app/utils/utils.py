@@ -1,3 +1,5 @@
+from app.utils.matrix_io import MATRIX_EXTENSIONS
+
 ALLOWED_EXTENSIONS = {"txt", "csv", "tsv"}
 
 
@@ -13,3 +15,8 @@ def map_cluster_value(value):
 
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def allowed_matrix_file(filename):
+    # The expression matrix may also be a Matrix Market or AnnData file
+    return "." in filename and filename.rsplit(".", 1)[1].lower() in MATRIX_EXTENSIONS
@@ -0,0 +1,183 @@
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import sparse
+
+from app.utils import threads
+from app.utils.scoring import Incidence, gene_stats, score_expression
+
+# Persistent process pool for the TF scoring. The expression values, the gene
+# statistics, the prior network incidence matrices and the SD table are copied
+# once into shared memory and workers only receive block names and cell ranges
+# per task. Every worker limits its BLAS threads to TF_BLAS_THREADS, so the
+# pool uses TF_WORKERS * TF_BLAS_THREADS cores.
+
+TF_WORKERS = threads.TF_WORKERS
+TF_CHUNK_SIZE = int(os.getenv("TF_CHUNK_SIZE", "512"))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ProcessPoolExecutor:
+    # The pool is created on first use and shared by every later request. The
+    # spawn context keeps the workers safe from the threads of the web server
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            print(f"Starting TF worker pool with {TF_WORKERS} workers")
+            _pool = ProcessPoolExecutor(
+                max_workers=TF_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=threads.limit_blas_threads,
+                initargs=(threads.TF_BLAS_THREADS,),
+            )
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+
+atexit.register(shutdown_pool)
+
+
+class SharedArrays:
+    # Context manager holding named numpy arrays in shared memory blocks. The
+    # specs are small picklable tuples which workers use to attach to them
+
+    def __init__(self, **arrays):
+        self.blocks = {}
+        self.specs = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks[name] = block
+            self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    def __getitem__(self, name):
+        block_name, shape, dtype = self.specs[name]
+        return np.ndarray(shape, dtype=dtype, buffer=self.blocks[name].buf)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+
+def _attach(specs):
+    blocks, arrays = [], {}
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    return blocks, arrays
+
+
+def _csr(arrays, prefix, shape):
+    return sparse.csr_matrix(
+        (arrays[f"{prefix}_data"], arrays[f"{prefix}_indices"], arrays[f"{prefix}_indptr"]),
+        shape=shape,
+    )
+
+
+def _score_chunk(specs, incidence_shape, groups_shape, start, stop):
+    blocks, arrays = _attach(specs)
+    incidence = groups = None
+    try:
+        incidence = Incidence(
+            tfs=None,
+            genes=None,
+            n_edges=arrays["n_edges"],
+            positive=_csr(arrays, "positive", incidence_shape),
+            negative=_csr(arrays, "negative", incidence_shape),
+        )
+        groups = _csr(arrays, "groups", groups_shape) if groups_shape else None
+        arrays["output"][start:stop] = score_expression(
+            arrays["values"],
+            arrays["mean"],
+            arrays["std"],
+            incidence,
+            arrays["distribution"],
+            groups,
+            start=start,
+            stop=stop,
+        )
+    finally:
+        # Drop the views before closing the blocks they point into
+        del arrays, incidence, groups
+        for block in blocks:
+            block.close()
+
+
+def _csr_arrays(prefix, matrix):
+    matrix = sparse.csr_matrix(matrix)
+    return {
+        f"{prefix}_data": matrix.data,
+        f"{prefix}_indices": matrix.indices,
+        f"{prefix}_indptr": matrix.indptr,
+    }
+
+
+def score_cells(
+        values: np.ndarray,
+        incidence: Incidence,
+        distribution: np.ndarray,
+        groups=None,
+        chunk_size: int = TF_CHUNK_SIZE,
+        stats=None,
+) -> np.ndarray:
+    # values is genes x cells and NaN where the gene is not measured; returns a
+    # cells x TFs array of signed p-values. stats is the (mean, SD) of every
+    # gene when values is only a part of the cells
+    n_cells = values.shape[1]
+    mean, std = gene_stats(values) if stats is None else stats
+    if TF_WORKERS <= 1 or n_cells <= chunk_size:
+        return score_expression(values, mean, std, incidence, distribution, groups)
+
+    arrays = dict(
+        values=values,
+        mean=mean,
+        std=std,
+        distribution=distribution,
+        n_edges=incidence.n_edges,
+        output=np.empty((n_cells, len(incidence.n_edges))),
+        **_csr_arrays("positive", incidence.positive),
+        **_csr_arrays("negative", incidence.negative),
+    )
+    if groups is not None:
+        arrays.update(_csr_arrays("groups", groups))
+
+    incidence_shape = incidence.positive.shape
+    groups_shape = groups.shape if groups is not None else None
+
+    with SharedArrays(**arrays) as shared:
+        try:
+            futures = [
+                get_pool().submit(
+                    _score_chunk, shared.specs, incidence_shape, groups_shape, start, start + chunk_size
+                )
+                for start in range(0, n_cells, chunk_size)
+            ]
+            for future in futures:
+                future.result()
+        except BrokenProcessPool:
+            # A crashed worker takes the pool down; start a fresh one next time
+            shutdown_pool()
+            raise
+        return shared["output"].copy()
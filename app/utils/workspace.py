@@ -0,0 +1,99 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+
+# Per-job workspaces. Every upload gets its own folder named by a fresh UUID
+# under the uploads folder; only UUID named folders are ever resolved from
+# user input or removed by the retention policy, so shared files such as the
+# SD cache or the orthology table are never touched.
+
+UPLOAD_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads")
+
+# Workspaces older than this many seconds are removed ...
+WORKSPACE_RETENTION = int(os.getenv("WORKSPACE_RETENTION", str(7 * 24 * 60 * 60)))
+# ... and the oldest ones are removed while all together exceed this many bytes
+WORKSPACE_MAX_BYTES = int(os.getenv("WORKSPACE_MAX_BYTES", str(20 * 1024 ** 3)))
+# Minimum number of seconds between two cleanup passes
+WORKSPACE_CLEANUP_INTERVAL = int(os.getenv("WORKSPACE_CLEANUP_INTERVAL", "600"))
+
+JOB_STATUS_FILE = "job.json"
+
+_last_cleanup = 0
+_cleanup_lock = threading.Lock()
+
+
+def is_session_id(session_id: str) -> bool:
+    try:
+        return str(uuid.UUID(session_id)) == session_id
+    except (TypeError, ValueError, AttributeError):
+        return False
+
+
+def workspace_path(session_id: str) -> str:
+    # Raises ValueError for anything that is not a session ID, which keeps
+    # user supplied IDs from escaping the uploads folder
+    if not is_session_id(session_id):
+        raise ValueError(f"Invalid session ID: {session_id}")
+    return os.path.join(UPLOAD_DIR, session_id)
+
+
+def workspace_exists(session_id: str) -> bool:
+    return is_session_id(session_id) and os.path.isdir(workspace_path(session_id))
+
+
+def create_workspace(keep=()):
+    # Returns (session_id, path) of a new, empty workspace. makedirs without
+    # exist_ok makes the creation atomic even with concurrent requests
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    cleanup_workspaces(keep=keep)
+    while True:
+        session_id = str(uuid.uuid4())
+        path = workspace_path(session_id)
+        try:
+            os.makedirs(path)
+        except FileExistsError:
+            continue
+        return session_id, path
+
+
+def _workspace_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def cleanup_workspaces(keep=(), force: bool = False):
+    # Applies the retention policy; workspaces listed in keep (e.g. of running
+    # jobs) are never removed. Runs at most once per cleanup interval unless forced
+    global _last_cleanup
+    with _cleanup_lock:
+        now = time.time()
+        if not force and now - _last_cleanup < WORKSPACE_CLEANUP_INTERVAL:
+            return
+        _last_cleanup = now
+
+        if not os.path.isdir(UPLOAD_DIR):
+            return
+
+        workspaces = []
+        for session_id in os.listdir(UPLOAD_DIR):
+            path = os.path.join(UPLOAD_DIR, session_id)
+            if not is_session_id(session_id) or not os.path.isdir(path) or session_id in keep:
+                continue
+            workspaces.append((os.path.getmtime(path), session_id, path, _workspace_size(path)))
+
+        workspaces.sort()
+        total = sum(size for _, _, _, size in workspaces)
+        for mtime, session_id, path, size in workspaces:
+            if now - mtime < WORKSPACE_RETENTION and total <= WORKSPACE_MAX_BYTES:
+                break
+            print(f"Removing workspace {session_id}")
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -0,0 +1,114 @@
+import argparse
+import time
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from scipy.stats import zscore
+
+from app.utils.priors import PriorNetwork
+from app.utils.scoring import (
+    build_incidence,
+    duplicate_groups,
+    gene_stats,
+    rank_cells,
+    rank_sum_p_values,
+    rank_sums,
+    score_expression,
+    score_ranks,
+    zscore_tile,
+)
+
+# Per-stage timings of the fused, tiled TF scoring (z-score, rank, rank-sum,
+# SD lookup and erf per tile of cells) against the unfused pipeline (pandas
+# z-score of the whole matrix, then ranking and scoring all cells at once).
+# Runs in one process on synthetic data.
+#
+#   python -m benchmarks.bench_scoring --genes 10000 --cells 5000 --tfs 500 --tile-size 64
+
+
+def synthetic(n_genes: int, n_cells: int, n_tfs: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    values = rng.gamma(2.0, 1.0, (n_genes, n_cells))
+    values[rng.random(values.shape) < 0.5] = np.nan  # Zeros of a sparse matrix
+    genes = pd.Index([f"G{i}" for i in range(n_genes)])
+
+    sizes = rng.integers(3, 200, n_tfs)
+    prior_network = PriorNetwork.from_edges(
+        tf=np.repeat([f"TF{i}" for i in range(n_tfs)], sizes),
+        action=rng.choice([1, -1], sizes.sum()),
+        target=genes[rng.integers(0, n_genes, sizes.sum())],
+    )
+    distribution = np.linspace(0.05, 0.005, prior_network.max_target)
+    return values, genes, prior_network, distribution
+
+
+class Timer:
+    def __init__(self):
+        self.totals = defaultdict(float)
+
+    def __call__(self, stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.totals[stage] += time.perf_counter() - start
+        return result
+
+    def report(self, title):
+        total = sum(self.totals.values())
+        print(title)
+        for stage, seconds in self.totals.items():
+            print(f"  {stage:<12} {seconds:8.3f}s  {100 * seconds / total:5.1f}%")
+        print(f"  {'total':<12} {total:8.3f}s")
+        return total
+
+
+def unfused(values, genes, incidence, distribution, groups):
+    timer = Timer()
+    frame = pd.DataFrame(values, index=genes)
+    z_scores = timer("zscore", lambda: frame.apply(zscore, axis=1, nan_policy="omit").T.to_numpy())
+    rank, rev_rank = timer("rank", rank_cells, z_scores)
+    p_vals = timer("score", score_ranks, rank, rev_rank, incidence, distribution, groups)
+    return p_vals, timer.report("unfused (pandas z-score, all cells at once)")
+
+
+def fused(values, incidence, distribution, groups, tile_size):
+    # Same loop as score_expression, with every stage timed separately
+    timer = Timer()
+    mean, std = timer("gene stats", gene_stats, values)
+    p_vals = np.empty((values.shape[1], len(incidence.n_edges)))
+    for begin in range(0, values.shape[1], tile_size):
+        end = min(begin + tile_size, values.shape[1])
+        z_scores = timer("zscore", zscore_tile, values[:, begin:end], mean, std)
+        rank, rev_rank = timer("rank", rank_cells, z_scores)
+        rs, valid_targets, invalid = timer("rank-sum", rank_sums, rank, rev_rank, incidence, groups)
+        p_vals[begin:end] = timer("sd + erf", rank_sum_p_values, rs, valid_targets, invalid, distribution)
+    return p_vals, timer.report(f"fused (tiles of {tile_size} cells)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fused TF scoring pipeline")
+    parser.add_argument("--genes", type=int, default=10_000)
+    parser.add_argument("--cells", type=int, default=5_000)
+    parser.add_argument("--tfs", type=int, default=500)
+    parser.add_argument("--tile-size", type=int, default=64)
+    args = parser.parse_args()
+
+    values, genes, prior_network, distribution = synthetic(args.genes, args.cells, args.tfs)
+    incidence = build_incidence(prior_network, genes)
+    groups = duplicate_groups(genes)
+    print(f"genes={args.genes} cells={args.cells} tfs={args.tfs} edges={len(prior_network.targets)}")
+
+    reference, reference_time = unfused(values, genes, incidence, distribution, groups)
+    candidate, candidate_time = fused(values, incidence, distribution, groups, args.tile_size)
+
+    start = time.perf_counter()
+    mean, std = gene_stats(values)
+    score_expression(values, mean, std, incidence, distribution, groups, tile_size=args.tile_size)
+    print(f"score_expression {time.perf_counter() - start:8.3f}s (untimed stages)")
+
+    diff = np.nanmax(np.abs(candidate - reference))
+    print(f"speedup {reference_time / candidate_time:.1f}x  max abs. diff {diff:.2e}")
+
+
+if __name__ == "__main__":
+    main()
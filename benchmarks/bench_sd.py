@@ -0,0 +1,58 @@
+import argparse
+import time
+
+import numpy as np
+
+from app.utils import run_analysis, tf_analysis
+
+# Compares the SD tables used by the TF analysis against the original Monte
+# Carlo loops (one np.random.choice draw per iteration):
+#   tf_analysis:  analytic closed form vs. simulated SD of the average rank
+#   run_analysis: vectorized simulator vs. simulated SD of the min-folded rank
+#
+#   python -m benchmarks.bench_sd --max-target 500 --total-genes 10000 --iters 1000
+
+
+def reference_sd(worker, max_target: int, total_genes: int, iters: int):
+    ranks = np.linspace(start=1, stop=total_genes, num=total_genes)
+    ranks = (ranks - 0.5) / total_genes
+    dist = [worker(max_target, ranks) for _ in range(iters)]
+    return np.std(np.array(dist).T, axis=1)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def report(name, reference, reference_time, candidate, candidate_time):
+    rel = np.abs(candidate - reference) / reference
+    print(
+        f"{name:<13} reference {reference_time:8.3f}s  candidate {candidate_time:8.3f}s  "
+        f"speedup {reference_time / candidate_time:9.1f}x  "
+        f"max rel. diff {rel.max():.4f}  mean rel. diff {rel.mean():.4f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SD tables of the TF analysis")
+    parser.add_argument("--max-target", type=int, default=500)
+    parser.add_argument("--total-genes", type=int, default=10_000)
+    parser.add_argument("--iters", type=int, default=1000)
+    args = parser.parse_args()
+
+    shape = (args.max_target, args.total_genes, args.iters)
+    print(f"max_target={shape[0]} total_genes={shape[1]} iters={shape[2]}")
+
+    reference, reference_time = timed(reference_sd, tf_analysis.distribution_worker, *shape)
+    candidate, candidate_time = timed(tf_analysis.analytic_sd, *shape[:2])
+    report("tf_analysis", reference, reference_time, candidate, candidate_time)
+
+    reference, reference_time = timed(reference_sd, run_analysis.distribution_worker, *shape)
+    candidate, candidate_time = timed(run_analysis.simulate_distribution, *shape)
+    report("run_analysis", reference, reference_time, candidate, candidate_time)
+
+
+if __name__ == "__main__":
+    main()
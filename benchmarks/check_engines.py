@@ -0,0 +1,78 @@
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+from app.utils.priors import PriorNetwork
+from app.utils.run_analysis import run_analysis
+
+# Checks that the vectorized scoring engine gives the p-values of the original
+# per-cell legacy engine. The expression values are integer counts, so many
+# z-scores tie exactly and both engines must rank them the same way; the
+# duplicate gene rows (several mouse genes mapped to one human gene) cover the
+# averaged target ranks. Exits with status 1 when a p-value differs by more
+# than the tolerance (the ranks of the vectorized engine are float32) or a
+# sign or NaN differs.
+#
+#   python -m benchmarks.check_engines --genes 400 --cells 60 --tfs 40
+
+
+def synthetic_counts(n_genes: int, n_cells: int, n_tfs: int, duplicates: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    values = rng.poisson(2.0, (n_genes, n_cells)).astype(np.float64)
+    values[values == 0] = np.nan  # Zeros of a sparse matrix
+    names = np.array([f"G{i}" for i in range(n_genes)])
+    names[rng.choice(n_genes, duplicates, replace=False)] = names[rng.choice(n_genes, duplicates)]
+    gene_exp = pd.DataFrame(
+        values, index=pd.Index(names, name="index"), columns=[f"cell.{i}" for i in range(n_cells)]
+    )
+
+    genes = pd.unique(names)
+    sizes = rng.integers(3, 40, n_tfs)
+    prior_network = PriorNetwork.from_edges(
+        tf=np.repeat([f"TF{i}" for i in range(n_tfs)], sizes),
+        action=rng.choice([1, -1], sizes.sum()),
+        target=genes[rng.integers(0, len(genes), sizes.sum())],
+    )
+    distribution = np.linspace(0.05, 0.005, prior_network.max_target)
+    return gene_exp, prior_network, distribution
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the vectorized scoring engine against the legacy one")
+    parser.add_argument("--genes", type=int, default=400)
+    parser.add_argument("--cells", type=int, default=60)
+    parser.add_argument("--tfs", type=int, default=40)
+    parser.add_argument("--duplicates", type=int, default=60, help="Gene rows renamed to another gene")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tolerance", type=float, default=1e-6)
+    args = parser.parse_args()
+
+    gene_exp, prior_network, distribution = synthetic_counts(
+        args.genes, args.cells, args.tfs, args.duplicates, args.seed
+    )
+    p_values = {
+        engine: run_analysis(
+            prior_network.tfs, gene_exp, prior_network, distribution, iters=0, engine=engine
+        ).to_numpy(dtype=np.float64)
+        for engine in ("legacy", "vectorized")
+    }
+    legacy, vectorized = p_values["legacy"], p_values["vectorized"]
+
+    nan_mismatches = int((np.isnan(legacy) != np.isnan(vectorized)).sum())
+    sign_mismatches = int((np.sign(legacy) != np.sign(vectorized))[~np.isnan(legacy)].sum())
+    difference = np.abs(legacy - vectorized)
+    max_difference = float(np.nanmax(difference)) if np.isfinite(difference).any() else 0.0
+    print(
+        f"genes={args.genes} cells={args.cells} tfs={args.tfs} duplicates={args.duplicates}  "
+        f"max |dp| {max_difference:.3g}  sign mismatches {sign_mismatches}  NaN mismatches {nan_mismatches}"
+    )
+    if nan_mismatches or sign_mismatches or max_difference > args.tolerance:
+        print("Engines differ")
+        sys.exit(1)
+    print("Engines agree")
+
+
+if __name__ == "__main__":
+    main()
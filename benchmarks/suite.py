@@ -0,0 +1,253 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+# Benchmark suite of the whole pipeline on synthetic data. Every size writes an
+# expression matrix (mouse genes x cells), metadata, a mouse to human table and
+# a prior network into a scratch folder, then times each stage cold (all caches
+# point into the scratch folder) and records the peak RSS of the stage. Runs
+# offline on the CPU.
+#
+#   python -m benchmarks.suite --sizes small medium --output results.json
+#   python -m benchmarks.suite --baseline benchmarks/baseline.json
+#   python -m benchmarks.suite --sizes small --save-baseline benchmarks/baseline.json
+#   python -m benchmarks.suite --cpu-budget 8 --baseline benchmarks/baseline.json
+
+SIZES = {
+    "small": dict(cells=500, genes=2_000, tfs=100, edges=40, sparsity=0.8),
+    "medium": dict(cells=3_000, genes=10_000, tfs=400, edges=60, sparsity=0.85),
+    "large": dict(cells=20_000, genes=20_000, tfs=1_000, edges=80, sparsity=0.9),
+}
+
+# Untimed run before the first size so numba compiling UMAP is not measured
+WARMUP = dict(cells=200, genes=500, tfs=20, edges=10, sparsity=0.5)
+
+UMAP_PARAMS = dict(
+    organism="mouse",
+    filter_cells="off",
+    filter_genes="off",
+    qc_filter="off",
+    data_normalize="on",
+    data_normalize_value=10_000,
+    log_transform="on",
+    pca_components=10,
+    n_neighbors=15,
+    min_dist=0.1,
+    metric="euclidean",
+)
+
+# Stages faster than this are not reported as regressions (timer noise)
+NOISE_SECONDS = 0.05
+
+
+def write_inputs(folder, cells, genes, tfs, edges, sparsity, seed=0):
+    rng = np.random.default_rng(seed)
+    cell_names = [f"cell.{i}" for i in range(cells)]
+    mouse = [f"Gene{i}" for i in range(genes)]
+    human = np.array([f"HGENE{i}" for i in range(genes)])
+
+    counts = rng.poisson(3.0, (genes, cells)).astype(np.float32)
+    counts[rng.random(counts.shape) < sparsity] = 0
+    pd.DataFrame(counts, index=mouse, columns=cell_names).to_csv(
+        os.path.join(folder, "matrix.tsv"), sep="\t", float_format="%g"
+    )
+
+    groups = rng.integers(0, 5, cells)
+    pd.DataFrame({"orig.ident": [f"sample{g}" for g in groups]}, index=cell_names).to_csv(
+        os.path.join(folder, "meta.tsv"), sep="\t"
+    )
+
+    # 90% of the mouse genes map to one human gene, a few to two, the rest to none
+    mapped = []
+    for i in range(genes):
+        draw = rng.random()
+        mapped.append(f"[{human[i]}]" if draw < 0.85 else f"[{human[i]},{human[(i + 1) % genes]}]" if draw < 0.9 else "")
+    pd.DataFrame({"Mouse": mouse, "Human": mapped}).to_csv(
+        os.path.join(folder, "mouse_to_human.tsv"), sep="\t", index=False
+    )
+
+    sizes = rng.integers(max(1, edges // 4), edges * 2, tfs)
+    actions = rng.choice(["upregulates-expression", "downregulates-expression"], sizes.sum())
+    prior_network = pd.DataFrame({
+        "tf": np.repeat(human[rng.choice(genes, tfs, replace=False)], sizes),
+        "action": actions,
+        "target": human[rng.integers(0, genes, sizes.sum())],
+    })
+    prior_network.to_csv(os.path.join(folder, "prior.tsv"), sep="\t", header=False, index=False)
+
+
+def reset_peak_rss():
+    # Linux resets the peak RSS (VmHWM) of the process on this write
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Stages:
+    def __init__(self):
+        self.results = {}
+
+    def __call__(self, stage, func, *args, **kwargs):
+        reset_peak_rss()
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        self.results[stage] = dict(seconds=round(seconds, 4), peak_rss_mb=round(peak_rss_mb(), 1))
+        print(f"  {stage:<16} {seconds:9.3f}s  {self.results[stage]['peak_rss_mb']:9.1f} MB")
+        return result
+
+
+def run_size(name, params, iters):
+    from app.utils import run_analysis
+    from app.utils.benjamini_hotchberg import bh_frd_correction
+    from app.utils.dataset import SessionDataset
+    from app.utils.orthologs import get_ortholog_index
+    from app.utils.priors import load_prior
+    from app.utils.run_umap_pipeline import run_umap_pipeline
+    from app.utils.scoring import build_incidence, duplicate_groups, gene_stats, zscore_tile
+    from app.utils.worker_pool import score_cells
+
+    folder = os.environ["BENCHMARK_DIR"]
+    print(f"{name}: {params}")
+    write_inputs(folder, **params)
+
+    stages = Stages()
+    dataset = stages("parse", SessionDataset, folder, "matrix.tsv", "meta.tsv")
+    stages("prior_compile", load_prior, os.path.join(folder, "prior.tsv"))
+    stages("ortholog_index", get_ortholog_index)
+    stages("orthology", dataset.human_genes)
+    stages("umap", run_umap_pipeline, "matrix.tsv", "meta.tsv", dataset=dataset, **UMAP_PARAMS)
+
+    prior_network, gene_exp = stages("tf_input", run_analysis.read_data, "prior.tsv", None, folder, dataset)
+    values = gene_exp.to_numpy(dtype=np.float64)
+
+    def zscore_all():
+        mean, std = gene_stats(values)
+        for begin in range(0, values.shape[1], 64):
+            zscore_tile(values[:, begin:begin + 64], mean, std)
+
+    stages("zscore", zscore_all)
+    distribution = stages("sd_table", run_analysis.get_sd, prior_network.max_target, len(values), iters)
+
+    incidence = build_incidence(prior_network, gene_exp.index)
+    groups = duplicate_groups(gene_exp.index)
+    output = stages("scoring", score_cells, values, incidence, distribution, groups)
+    p_values = pd.DataFrame(output, index=gene_exp.columns, columns=prior_network.tfs).dropna(axis=1, how="all")
+    stages("bh", bh_frd_correction, p_values)
+
+    return dict(params=params, iters=iters, shape=list(values.shape), stages=stages.results)
+
+
+def compare(results, baseline, tolerance):
+    # Returns the regressions: stages slower than baseline by more than tolerance
+    regressions = []
+    print(f"{'size':<8} {'stage':<16} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for name, result in results["sizes"].items():
+        base_size = baseline["sizes"].get(name)
+        if base_size is None:
+            continue
+        for stage, current in result["stages"].items():
+            base = base_size["stages"].get(stage)
+            if base is None:
+                continue
+            ratio = current["seconds"] / max(base["seconds"], 1e-9)
+            slower = ratio > 1 + tolerance and current["seconds"] - base["seconds"] > NOISE_SECONDS
+            print(
+                f"{name:<8} {stage:<16} {base['seconds']:9.3f}s {current['seconds']:9.3f}s {ratio:6.2f}x"
+                + ("  REGRESSION" if slower else "")
+            )
+            if slower:
+                regressions.append((name, stage, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the pipeline on synthetic data")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["small", "medium"])
+    parser.add_argument("--iters", type=int, default=1000, help="SD simulation iterations")
+    parser.add_argument("--workers", type=int, help="TF scoring workers (TF_WORKERS)")
+    parser.add_argument("--cpu-budget", type=int, help="Cores split between the UMAP and TF branches (CPU_BUDGET)")
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--baseline", help="Compare against a stored results JSON")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown before a regression")
+    parser.add_argument("--save-baseline", help="Write the results as the new baseline")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix="tf-benchmark-")
+    # Caches and the ortholog index live in the scratch folder, so every stage runs cold
+    os.environ.update(
+        BENCHMARK_DIR=scratch,
+        SD_CACHE_DIR=os.path.join(scratch, "sd_cache"),
+        PRIOR_CACHE_DIR=os.path.join(scratch, "prior_cache"),
+        STAGE_CACHE_DIR=os.path.join(scratch, "stage_cache"),
+        ORTHOLOG_DIR=os.path.join(scratch, "orthologs"),
+        ORTHOLOG_SOURCE=os.path.join(scratch, "mouse_to_human.tsv"),
+    )
+    if args.workers:
+        os.environ["TF_WORKERS"] = str(args.workers)
+    if args.cpu_budget:
+        os.environ["CPU_BUDGET"] = str(args.cpu_budget)
+
+    try:
+        from app.utils import threads, worker_pool
+
+        results = dict(
+            machine=dict(
+                platform=platform.platform(),
+                python=platform.python_version(),
+                cpus=os.cpu_count(),
+                cpu_budget=threads.CPU_BUDGET,
+                umap_threads=threads.UMAP_THREADS,
+                tf_workers=worker_pool.TF_WORKERS,
+            ),
+            sizes={},
+        )
+        run_size("warmup", WARMUP, 10)
+        for name in args.sizes:
+            # Every size starts with empty caches
+            for cache in ("sd_cache", "prior_cache", "stage_cache", "orthologs"):
+                shutil.rmtree(os.path.join(scratch, cache), ignore_errors=True)
+            results["sizes"][name] = run_size(name, SIZES[name], args.iters)
+        worker_pool.shutdown_pool()
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+            print(f"Wrote {path}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} stage(s) slower than the baseline")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()